@@ -1,16 +1,75 @@
 import re
-from typing import List, Dict
+from typing import List, Dict, NamedTuple, Optional
 import os
+import time
+import asyncio
+import hashlib
+import threading
+import aiohttp
 from openai import OpenAI
 from loguru import logger
 import requests
 from dotenv import load_dotenv
+from dify_api import ANSWER_EVENTS, parse_sse_line, iter_dify_events
+from reply_cache import ReplyCache, Uncached
+from backend_health import BackendHealth, BackendUnavailable
+import metrics
 
 # 加载环境变量
 load_dotenv()
 
+class SafetyFilter:
+    """安全过滤：回复中出现站外联系或交易方式时，整条替换为平台沟通提醒"""
+
+    def __init__(self, blocked_phrases=None, replacement="[安全提醒]请通过平台沟通"):
+        self.blocked_phrases = blocked_phrases or ["微信", "QQ", "支付宝", "银行卡", "线下"]
+        self.replacement = replacement
+
+    def __call__(self, text: str) -> str:
+        return self.replacement if any(p in text for p in self.blocked_phrases) else text
+
+    def stream(self):
+        """返回流式检查器，逐段检查回复"""
+        return StreamSafetyCheck(self)
+
+
+class StreamSafetyCheck:
+    """流式安全检查：每段只检查新内容和上一段末尾可能跨段的部分，收到结束事件即可得到最终回复"""
+
+    def __init__(self, safety_filter: SafetyFilter):
+        self.safety_filter = safety_filter
+        self.parts = []
+        self.tail = ''
+        # 跨段的屏蔽词最多有 最长词长度-1 个字落在上一段
+        self.overlap = max(len(p) for p in safety_filter.blocked_phrases) - 1
+        self.blocked = False
+
+    def feed(self, chunk: str) -> bool:
+        """加入一段回复，命中屏蔽词时返回 False，之后的内容不再需要"""
+        window = self.tail + chunk
+        if any(p in window for p in self.safety_filter.blocked_phrases):
+            self.blocked = True
+            return False
+        self.parts.append(chunk)
+        self.tail = window[-self.overlap:] if self.overlap else ''
+        return True
+
+    def result(self) -> str:
+        return self.safety_filter.replacement if self.blocked else ''.join(self.parts)
+
+
+class DifyReply(NamedTuple):
+    """Dify 回复"""
+    answer: str
+    conversation_id: Optional[str]
+
+
 class DifyAgent():
     """Dify API 处理 Agent"""
+
+    FALLBACK_REPLY = "抱歉，我现在无法回答您的问题，请稍后再试。"
+    ERROR_REPLY = "抱歉，服务暂时出现问题，请稍后再试。"
+    BUSY_REPLY = "亲，当前咨询的人比较多，稍后给您详细回复哦~"
     
     def __init__(self, client=None, system_prompt=None, safety_filter=None):
         """
@@ -25,24 +84,55 @@ class DifyAgent():
         self.api_key = os.getenv('DIFY_API_KEY')
         if not self.api_key:
             raise ValueError("请在.env文件中设置DIFY_API_KEY环境变量")
-    
-    def generate(self, user_msg: str, user_id: str, image_url: str = None, order_id: str = None) -> str:
-        """重写生成逻辑，使用 Dify API"""
-        url = "http://127.0.0.1/v1/chat-messages"
-        
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
-        }
-        
+        self.base_url = os.getenv('DIFY_BASE_URL', 'http://127.0.0.1/v1').rstrip('/')
+        # blocking：等待完整回复；streaming：逐段读取 SSE 事件，可统计首字耗时并在中途取消
+        self.response_mode = os.getenv('DIFY_RESPONSE_MODE', 'streaming')
+        # 建连、单次读取和整个请求的超时（秒）
+        self.timeout = aiohttp.ClientTimeout(
+            total=float(os.getenv('DIFY_TOTAL_TIMEOUT', '120')),
+            connect=float(os.getenv('DIFY_CONNECT_TIMEOUT', '5')),
+            sock_read=float(os.getenv('DIFY_READ_TIMEOUT', '60'))
+        )
+        # 同时进行的请求数上限，也是连接池大小
+        self.max_concurrency = int(os.getenv('DIFY_MAX_CONCURRENCY', '8'))
+        # 自适应并发上限与熔断器：Dify 变慢时减小并发，持续失败时熔断并返回 BUSY_REPLY
+        self.health = BackendHealth(
+            'dify',
+            max_limit=self.max_concurrency,
+            latency_target=float(os.getenv('DIFY_LATENCY_TARGET', '30')),
+            max_wait=float(os.getenv('DIFY_QUEUE_TIMEOUT', '10'))
+        )
+        # 每个事件循环一个长连接会话和并发信号量（aiohttp 会话不能跨事件循环使用）
+        self._sessions = {}
+        self._semaphores = {}
+        self._loop = None
+        self._loop_lock = threading.Lock()
+        self._stop_tasks = set()
+
+    def _session(self):
+        loop = asyncio.get_running_loop()
+        session = self._sessions.get(loop)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_concurrency, keepalive_timeout=60)
+            session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=self.timeout,
+                headers={"Authorization": f"Bearer {self.api_key}"}
+            )
+            self._sessions[loop] = session
+            self._semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+        return session, self._semaphores[loop]
+
+    def _build_payload(self, user_msg: str, user_id: str, image_url: str = None, order_id: str = None,
+                       conversation_id: str = "") -> Dict:
         # 准备请求数据
         payload = {
             "inputs": {
                 "order_id": order_id if order_id else ""
             },
             "query": user_msg,
-            "response_mode": "blocking",
-            "conversation_id": "",
+            "response_mode": self.response_mode,
+            "conversation_id": conversation_id or "",
             "user": user_id
         }
         
@@ -55,31 +145,179 @@ class DifyAgent():
                     "url": image_url
                 }
             ]
-        
+        return payload
+
+    async def agenerate(self, user_msg: str, user_id: str, image_url: str = None, order_id: str = None) -> str:
+        """使用 Dify API 生成回复（复用连接池的异步请求）"""
+        return (await self.achat(user_msg, user_id, image_url=image_url, order_id=order_id)).answer
+
+    async def achat(self, user_msg: str, user_id: str, image_url: str = None, order_id: str = None,
+                    conversation_id: str = "") -> DifyReply:
+        """在 Dify 会话中生成回复
+
+        传入 conversation_id 时由 Dify 保存对话历史；会话已不存在时自动新建一次。
+        流式模式下任务被取消时立即断开连接，并通知 Dify 停止生成。
+        Dify 熔断或排队超时时不发送请求，直接返回 BUSY_REPLY
+
+        Returns:
+            DifyReply: 回复与 Dify 返回的会话ID（请求失败或降级时会话ID为None）
+        """
+        if not await self.health.aacquire():
+            return DifyReply(self.BUSY_REPLY, None)
+        started = time.monotonic()
+        latency = None
+        ok = False
         try:
-            # 发送POST请求
-            response = requests.post(url, headers=headers, json=payload)
-            
-            if response.status_code == 200:
-                answer = response.json().get('answer', '')
-                # 如果answer为空，直接返回
-                if not answer:
-                    return "抱歉，我现在无法回答您的问题，请稍后再试。"
-                return self.safety_filter(answer)
-            else:
-                logger.error(f"Dify API 请求失败: {response.status_code} - {response.text}")
-                return "抱歉，我现在无法回答您的问题，请稍后再试。"
+            reply = await self._achat(user_msg, user_id, image_url, order_id, conversation_id)
+            ok = reply.answer not in (self.FALLBACK_REPLY, self.ERROR_REPLY)
+            latency = time.monotonic() - started
+            return reply
+        finally:
+            # 被取消的调用只归还名额，不计入健康统计
+            self.health.release(latency, ok)
+
+    async def _achat(self, user_msg: str, user_id: str, image_url: str = None, order_id: str = None,
+                     conversation_id: str = "") -> DifyReply:
+        payload = self._build_payload(user_msg, user_id, image_url, order_id, conversation_id)
+        session, semaphore = self._session()
+        started = time.monotonic()
+        missing = False
+        try:
+            async with semaphore:
+                async with session.post(f"{self.base_url}/chat-messages", json=payload) as response:
+                    if response.status == 404 and conversation_id:
+                        logger.warning(f"Dify 会话 {conversation_id} 已不存在，新建会话")
+                        metrics.inc('dify.conversation_missing')
+                        missing = True
+                    elif response.status != 200:
+                        logger.error(f"Dify API 请求失败: {response.status} - {await response.text()}")
+                        return DifyReply(self.FALLBACK_REPLY, None)
+                    elif self.response_mode == 'streaming':
+                        return await self._read_stream(response, user_id, started)
+                    else:
+                        data = await response.json()
+            if missing:
+                return await self._achat(user_msg, user_id, image_url=image_url, order_id=order_id)
+            metrics.observe('dify.latency', time.monotonic() - started)
+            answer = data.get('answer', '')
+            # 如果answer为空，直接返回
+            if not answer:
+                return DifyReply(self.FALLBACK_REPLY, None)
+            return DifyReply(self.safety_filter(answer), data.get('conversation_id'))
+        except asyncio.CancelledError:
+            raise
+        except asyncio.TimeoutError:
+            logger.error(f"Dify API 请求超时: {self.timeout}")
+            return DifyReply(self.ERROR_REPLY, None)
         except Exception as e:
             logger.error(f"Dify API 请求异常: {e}")
-            return "抱歉，服务暂时出现问题，请稍后再试。"
+            return DifyReply(self.ERROR_REPLY, None)
+
+    async def _read_stream(self, response, user_id: str, started: float) -> DifyReply:
+        """逐段读取 SSE 事件，边读边做安全检查，收到 message_end 即返回最终回复"""
+        check = self.safety_filter.stream() if hasattr(self.safety_filter, 'stream') else None
+        parts = []
+        task_id = None
+        conversation_id = None
+        buffer = b''
+        try:
+            async for data in response.content.iter_any():
+                *lines, buffer = (buffer + data).split(b'\n')
+                for line in lines:
+                    event = parse_sse_line(line)
+                    if event is None:
+                        continue
+                    task_id = task_id or event.get('task_id')
+                    conversation_id = conversation_id or event.get('conversation_id')
+                    kind = event.get('event')
+                    if kind in ANSWER_EVENTS:
+                        chunk = event.get('answer', '')
+                        if not chunk:
+                            continue
+                        if not parts:
+                            metrics.observe('dify.ttft', time.monotonic() - started)
+                        parts.append(chunk)
+                        if check and not check.feed(chunk):
+                            # 已命中屏蔽词，最终回复已确定，不再等待剩余内容
+                            metrics.inc('dify.blocked')
+                            self._stop_generation(task_id, user_id)
+                            return DifyReply(check.result(), conversation_id)
+                    elif kind == 'message_end':
+                        metrics.observe('dify.latency', time.monotonic() - started)
+                        if not parts:
+                            return DifyReply(self.FALLBACK_REPLY, None)
+                        answer = check.result() if check else self.safety_filter(''.join(parts))
+                        return DifyReply(answer, conversation_id)
+                    elif kind == 'error':
+                        logger.error(f"Dify API 流式响应错误: {event.get('status')} - {event.get('message')}")
+                        return DifyReply(self.FALLBACK_REPLY, None)
+        except asyncio.CancelledError:
+            metrics.inc('dify.cancelled')
+            self._stop_generation(task_id, user_id)
+            raise
+        logger.error("Dify API 流式响应未收到结束事件")
+        return DifyReply(self.FALLBACK_REPLY, None)
+
+    def _stop_generation(self, task_id: str, user_id: str):
+        """后台通知 Dify 停止生成，不等待结果"""
+        if not task_id:
+            return
+        task = asyncio.get_running_loop().create_task(self._post_stop(task_id, user_id))
+        self._stop_tasks.add(task)
+        task.add_done_callback(self._stop_tasks.discard)
+
+    async def _post_stop(self, task_id: str, user_id: str):
+        session, _ = self._session()
+        try:
+            async with session.post(f"{self.base_url}/chat-messages/{task_id}/stop", json={"user": user_id}) as response:
+                await response.read()
+        except Exception as e:
+            logger.debug(f"停止 Dify 生成失败: {e}")
+
+    def _background_loop(self):
+        """同步调用使用的后台事件循环"""
+        with self._loop_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name='DifyAgentLoop', daemon=True).start()
+        return self._loop
+
+    def generate(self, user_msg: str, user_id: str, image_url: str = None, order_id: str = None) -> str:
+        """同步接口，在后台事件循环中执行 agenerate"""
+        future = asyncio.run_coroutine_threadsafe(
+            self.agenerate(user_msg, user_id, image_url=image_url, order_id=order_id),
+            self._background_loop()
+        )
+        return future.result()
+
+    async def _close_session(self):
+        session = self._sessions.pop(asyncio.get_running_loop(), None)
+        if session:
+            await session.close()
+
+    async def aclose(self):
+        """关闭当前事件循环和后台事件循环中的会话"""
+        await self._close_session()
+        if self._loop is not None:
+            await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(self._close_session(), self._loop))
 
 class XianyuReplyBot:
-    def __init__(self):
+    def __init__(self, reply_cache=None):
         # 初始化OpenAI客户端
         self.client = OpenAI(
             api_key=os.getenv("OPENAI_API_KEY"),
             base_url="https://dashscope.aliyuncs.com/compatible-mode/v1"
         )
+        self.safety_filter = SafetyFilter()
+        # 通义千问的自适应并发上限与熔断器，所有 Agent 共用
+        self.llm_health = BackendHealth(
+            'dashscope',
+            max_limit=int(os.getenv('LLM_MAX_CONCURRENCY', '8')),
+            latency_target=float(os.getenv('LLM_LATENCY_TARGET', '20')),
+            max_wait=float(os.getenv('LLM_QUEUE_TIMEOUT', '10'))
+        )
+        # 非议价问题的回复缓存，默认只使用进程内缓存
+        self.reply_cache = reply_cache if reply_cache else ReplyCache()
         self._init_system_prompts()
         self._init_agents()
         self.router = IntentRouter(self.agents['classify'])
@@ -92,11 +330,11 @@ class XianyuReplyBot:
     def _init_agents(self):
         """初始化各领域Agent"""
         self.agents = {
-            'classify': ClassifyAgent(self.client, self.classify_prompt, self._safe_filter),
-            'price': PriceAgent(self.client, self.price_prompt, self._safe_filter),
-            'tech': TechAgent(self.client, self.tech_prompt, self._safe_filter),
-            'dify': DifyAgent(self.client, self.default_prompt, self._safe_filter),  # 添加 Dify Agent
-            'default': DefaultAgent(self.client, self.default_prompt, self._safe_filter),
+            'classify': ClassifyAgent(self.client, self.classify_prompt, self.safety_filter, self.llm_health),
+            'price': PriceAgent(self.client, self.price_prompt, self.safety_filter, self.llm_health),
+            'tech': TechAgent(self.client, self.tech_prompt, self.safety_filter, self.llm_health),
+            'dify': DifyAgent(self.client, self.default_prompt, self.safety_filter),  # 添加 Dify Agent
+            'default': DefaultAgent(self.client, self.default_prompt, self.safety_filter, self.llm_health),
         }
 
     def _init_system_prompts(self):
@@ -131,8 +369,7 @@ class XianyuReplyBot:
 
     def _safe_filter(self, text: str) -> str:
         """安全过滤模块"""
-        blocked_phrases = ["微信", "QQ", "支付宝", "银行卡", "线下"]
-        return "[安全提醒]请通过平台沟通" if any(p in text for p in blocked_phrases) else text
+        return self.safety_filter(text)
 
     def format_history(self, context: List[Dict]) -> str:
         """格式化对话历史，返回完整的对话记录"""
@@ -141,17 +378,38 @@ class XianyuReplyBot:
         return "\n".join([f"{msg['role']}: {msg['content']}" for msg in user_assistant_msgs])
 
     def generate_reply(self, user_msg: str, item_desc: str, context: List[Dict]) -> str:
-        """生成回复主流程"""
+        """生成回复主流程；先查回复缓存，未命中且大模型熔断或排队超时时返回繁忙提示"""
+        try:
+            return self._generate_reply(user_msg, item_desc, context)
+        except BackendUnavailable:
+            return DifyAgent.BUSY_REPLY
+
+    def _generate_reply(self, user_msg: str, item_desc: str, context: List[Dict]) -> str:
         # 记录用户消息
         # logger.debug(f'用户所发消息: {user_msg}')
         
         formatted_context = self.format_history(context)
         # logger.debug(f'对话历史: {formatted_context}')
-        
-        # 1. 路由决策
+
+        # 1. 先查回复缓存：键中的意图只用关键词规则判断，命中时不调用意图识别和回复大模型；
+        #    议价问题（含被技术类规则优先匹配但提到价格的消息）和带对话历史的回复依赖议价次数或买家上下文，不缓存
+        rule_intent = self.router.match_rules(user_msg) or 'default'
+        cache_key = None
+        if rule_intent != 'price' and not self.router.mentions_price(user_msg) and not formatted_context:
+            scope = hashlib.md5(item_desc.encode()).hexdigest() if item_desc else ''
+            cache_key = self.reply_cache.key(scope, rule_intent, user_msg)
+        self.last_intent = rule_intent
+        return self.reply_cache.get_or_create(
+            cache_key,
+            lambda: self._route_and_generate(user_msg, item_desc, context, formatted_context)
+        )
+
+    def _route_and_generate(self, user_msg: str, item_desc: str, context: List[Dict], formatted_context: str):
+        """未命中缓存时：意图路由（规则未命中时调用意图识别大模型）并生成回复"""
+        # 2. 路由决策
         detected_intent = self.router.detect(user_msg, item_desc, formatted_context)
 
-        # 2. 获取对应Agent
+        # 3. 获取对应Agent
         internal_intents = {'classify'}  # 定义不对外开放的Agent
 
         if detected_intent in self.agents and detected_intent not in internal_intents:
@@ -163,17 +421,18 @@ class XianyuReplyBot:
             logger.info(f'意图识别完成: default')
             self.last_intent = 'default'  # 保存当前意图
         
-        # 3. 获取议价次数
+        # 4. 获取议价次数
         bargain_count = self._extract_bargain_count(context)
         logger.info(f'议价次数: {bargain_count}')
 
-        # 4. 生成回复
-        return agent.generate(
+        # 5. 生成回复；大模型判定为议价时回复依赖议价次数，不写入缓存
+        reply = agent.generate(
             user_msg=user_msg,
             item_desc=item_desc,
             context=formatted_context,
             bargain_count=bargain_count
         )
+        return Uncached(reply) if self.last_intent == 'price' else reply
     
     def _extract_bargain_count(self, context: List[Dict]) -> int:
         """
@@ -214,7 +473,7 @@ class XianyuReplyBot:
         payload = {
             "inputs": {},
             "query": user_msg,
-            "response_mode": "blocking",
+            "response_mode": "streaming",
             "conversation_id": "",
             "user": "abc-123"
         }
@@ -229,17 +488,27 @@ class XianyuReplyBot:
                 }
             ]
         
-        # 发送POST请求
+        # 发送POST请求，流式读取回复并逐段做安全检查
         try:
-            response = requests.post(url, headers=headers, json=payload)
-            
-            if response.status_code == 200:
-                answer = response.json().get('answer', '')
-                return self._safe_filter(answer)
-            else:
-                logger.error(f"Dify API 请求失败: {response.status_code} - {response.text}")
-                # 如果Dify API失败，回退到默认回复生成
-                return self.generate_reply(user_msg, item_desc, context)
+            started = time.monotonic()
+            with requests.post(url, headers=headers, json=payload, stream=True, timeout=(5, 60)) as response:
+                if response.status_code != 200:
+                    logger.error(f"Dify API 请求失败: {response.status_code} - {response.text}")
+                    # 如果Dify API失败，回退到默认回复生成
+                    return self.generate_reply(user_msg, item_desc, context)
+                check = self.safety_filter.stream()
+                first = True
+                for event in iter_dify_events(response):
+                    if event.get('event') in ANSWER_EVENTS and event.get('answer'):
+                        if first:
+                            metrics.observe('dify.ttft', time.monotonic() - started)
+                            first = False
+                        if not check.feed(event['answer']):
+                            break
+                    elif event.get('event') == 'error':
+                        raise RuntimeError(event.get('message'))
+                metrics.observe('dify.latency', time.monotonic() - started)
+                return check.result()
         except Exception as e:
             logger.error(f"Dify API 请求异常: {e}")
             # 如果发生异常，回退到默认回复生成
@@ -265,14 +534,28 @@ class IntentRouter:
                 ]
             },
             'price': {
-                'keywords': ['便宜', '价', '砍价', '少点'],
-                'patterns': [r'\d+元', r'能少\d+']
+                'keywords': ['便宜', '价', '砍价', '少点', '少一点', '最低', '多少钱', '低点', '低一点', '优惠', '小刀'],
+                'patterns': [r'\d+元', r'能少\d+', r'(能|再|还|可以)少', r'少\d+', r'(能|可以|再)刀', r'刀(吗|一下|点)']
             }
         }
         self.classify_agent = classify_agent
 
     def detect(self, user_msg: str, item_desc, context) -> str:
         """三级路由策略（技术优先）"""
+        intent = self.match_rules(user_msg)
+        if intent:
+            return intent
+        
+        # 4. 大模型兜底
+        # logger.debug("使用大模型进行意图分类")
+        return self.classify_agent.generate(
+            user_msg=user_msg,
+            item_desc=item_desc,
+            context=context
+        )
+
+    def match_rules(self, user_msg: str) -> Optional[str]:
+        """只用关键词和正则判断意图（不调用大模型），未命中返回None"""
         text_clean = re.sub(r'[^\w\u4e00-\u9fa5]', '', user_msg)
         
         # 1. 技术类关键词优先检查
@@ -287,32 +570,33 @@ class IntentRouter:
                 return 'tech'
 
         # 3. 价格类检查
-        for intent in ['price']:
-            if any(kw in text_clean for kw in self.rules[intent]['keywords']):
-                # logger.debug(f"价格类关键词匹配: {[kw for kw in self.rules[intent]['keywords'] if kw in text_clean]}")
-                return intent
-            
-            for pattern in self.rules[intent]['patterns']:
-                if re.search(pattern, text_clean):
-                    # logger.debug(f"价格类正则匹配: {pattern}")
-                    return intent
-        
-        # 4. 大模型兜底
-        # logger.debug("使用大模型进行意图分类")
-        return self.classify_agent.generate(
-            user_msg=user_msg,
-            item_desc=item_desc,
-            context=context
-        )
+        if self._match_price(text_clean):
+            return 'price'
+        return None
+
+    def mentions_price(self, user_msg: str) -> bool:
+        """消息是否命中价格类关键词或正则（不考虑技术类优先），用于判断回复能否缓存"""
+        return self._match_price(re.sub(r'[^\w\u4e00-\u9fa5]', '', user_msg))
+
+    def _match_price(self, text_clean: str) -> bool:
+        if any(kw in text_clean for kw in self.rules['price']['keywords']):
+            # logger.debug(f"价格类关键词匹配: {[kw for kw in self.rules['price']['keywords'] if kw in text_clean]}")
+            return True
+        for pattern in self.rules['price']['patterns']:
+            if re.search(pattern, text_clean):
+                # logger.debug(f"价格类正则匹配: {pattern}")
+                return True
+        return False
 
 
 class BaseAgent:
     """Agent基类"""
 
-    def __init__(self, client, system_prompt, safety_filter):
+    def __init__(self, client, system_prompt, safety_filter, health=None):
         self.client = client
         self.system_prompt = system_prompt
         self.safety_filter = safety_filter
+        self.health = health  # BackendHealth，为空时不限制并发
 
     def generate(self, user_msg: str, item_desc: str, context: str, bargain_count: int = 0) -> str:
         """生成回复模板方法"""
@@ -327,16 +611,26 @@ class BaseAgent:
             {"role": "user", "content": user_msg}
         ]
 
-    def _call_llm(self, messages: List[Dict], temperature: float = 0.4) -> str:
-        """调用大模型"""
-        response = self.client.chat.completions.create(
-            model="qwen-max",
-            messages=messages,
-            temperature=temperature,
-            max_tokens=500,
-            top_p=0.8
-        )
-        return response.choices[0].message.content
+    def _call_llm(self, messages: List[Dict], temperature: float = 0.4, **kwargs) -> str:
+        """调用大模型；后端熔断或排队超时时抛出 BackendUnavailable"""
+        if self.health and not self.health.acquire():
+            raise BackendUnavailable(self.health.name)
+        started = time.monotonic()
+        ok = False
+        try:
+            response = self.client.chat.completions.create(
+                model="qwen-max",
+                messages=messages,
+                temperature=temperature,
+                max_tokens=500,
+                top_p=0.8,
+                **kwargs
+            )
+            ok = True
+            return response.choices[0].message.content
+        finally:
+            if self.health:
+                self.health.release(time.monotonic() - started, ok)
 
 
 class PriceAgent(BaseAgent):
@@ -348,14 +642,8 @@ class PriceAgent(BaseAgent):
         messages = self._build_messages(user_msg, item_desc, context)
         messages[0]['content'] += f"\n▲当前议价轮次：{bargain_count}"
 
-        response = self.client.chat.completions.create(
-            model="qwen-max",
-            messages=messages,
-            temperature=dynamic_temp,
-            max_tokens=500,
-            top_p=0.8
-        )
-        return self.safety_filter(response.choices[0].message.content)
+        response = self._call_llm(messages, temperature=dynamic_temp)
+        return self.safety_filter(response)
 
     def _calc_temperature(self, bargain_count: int) -> float:
         """动态温度策略"""
@@ -369,18 +657,15 @@ class TechAgent(BaseAgent):
         messages = self._build_messages(user_msg, item_desc, context)
         # messages[0]['content'] += "\n▲知识库：\n" + self._fetch_tech_specs()
 
-        response = self.client.chat.completions.create(
-            model="qwen-max",
-            messages=messages,
+        response = self._call_llm(
+            messages,
             temperature=0.4,
-            max_tokens=500,
-            top_p=0.8,
             extra_body={
                 "enable_search": True,
             }
         )
 
-        return self.safety_filter(response.choices[0].message.content)
+        return self.safety_filter(response)
 
 
     # def _fetch_tech_specs(self) -> str:
@@ -402,4 +687,14 @@ class DefaultAgent(BaseAgent):
     def _call_llm(self, messages: List[Dict], *args) -> str:
         """限制默认回复长度"""
         response = super()._call_llm(messages, temperature=0.7)
-        return response
\ No newline at end of file
+        return response
+
+if __name__ == '__main__':
+    # 自检：常见议价说法都应归为价格类，不进入跨买家的回复缓存
+    router = IntentRouter(None)
+    for msg in ['最低多少', '多少钱', '还能少吗', '可以再低点吗', '有优惠吗', '能刀吗', '小刀可以吗', '能少50吗', '100元出吗']:
+        assert router.match_rules(msg) == 'price' and router.mentions_price(msg), msg
+    for msg in ['还在吗', '包邮吗', '有多少个', '什么时候发货']:
+        assert router.match_rules(msg) is None and not router.mentions_price(msg), msg
+    assert router.match_rules('和新款比多少钱') == 'tech' and router.mentions_price('和新款比多少钱')
+    print('意图规则自检通过')
@@ -0,0 +1,208 @@
+"""
+大模型后端健康保护
+
+Dify / DashScope 变慢或故障时，避免所有会话都阻塞在大模型调用上：
+- 自适应并发上限（AIMD）：调用成功且耗时不超过目标时上限缓慢增加（约每轮 +1），
+  失败或超时时按比例减小；超过上限的调用排队等待，等待超时则降级
+- 熔断器：连续失败达到阈值，或统计窗口内错误率过高时打开，打开期间的调用立即降级；
+  冷却时间过后进入半开状态，只放行一个探测调用，成功则关闭，失败则重新打开
+- 降级的调用由调用方返回缓存或模板回复
+- 指标：backend.{名称}.limit / inflight / waiting / error_rate / state（0 关闭，1 半开，2 打开）仪表，
+  backend.{名称}.shed / trips 计数，backend.{名称}.latency 直方图
+"""
+import time
+import asyncio
+import threading
+from collections import deque
+from loguru import logger
+import metrics
+
+CLOSED = 'closed'
+HALF_OPEN = 'half_open'
+OPEN = 'open'
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class BackendUnavailable(RuntimeError):
+    """后端熔断或排队超时，本次调用被降级"""
+
+
+class BackendHealth:
+    """单个大模型后端的并发上限与熔断器，线程安全，同步与异步调用方可以共用"""
+
+    def __init__(self, name, max_limit=8, min_limit=1, latency_target=30.0, backoff_ratio=0.7,
+                 max_wait=10.0, failure_threshold=5, error_rate_threshold=0.5, window=60.0,
+                 min_calls=10, reset_timeout=30.0):
+        """
+        Args:
+            name: 后端名称，用于指标和日志
+            max_limit: 并发上限的最大值
+            min_limit: 并发上限的最小值
+            latency_target: 目标耗时（秒），超过时视为过载并减小并发上限
+            backoff_ratio: 过载或失败时并发上限乘以的比例
+            max_wait: 超过并发上限时最多排队等待的秒数
+            failure_threshold: 连续失败多少次打开熔断器
+            error_rate_threshold: 统计窗口内错误率达到多少时打开熔断器
+            window: 错误率统计窗口（秒）
+            min_calls: 统计窗口内至少有多少次调用才按错误率判断
+            reset_timeout: 熔断器打开后多少秒进入半开状态
+        """
+        self.name = name
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.latency_target = latency_target
+        self.backoff_ratio = backoff_ratio
+        self.max_wait = max_wait
+        self.failure_threshold = failure_threshold
+        self.error_rate_threshold = error_rate_threshold
+        self.window = window
+        self.min_calls = min_calls
+        self.reset_timeout = reset_timeout
+        self.limit = float(max_limit)
+        self.inflight = 0
+        self.state = CLOSED
+        self._opened_at = 0.0
+        self._probing = False
+        self._consecutive_failures = 0
+        self._outcomes = deque()  # (时间, 是否成功)
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._waiters = []        # 异步等待方：(事件循环, Future)
+        self._export()
+
+    def _metric(self, name):
+        return f'backend.{self.name}.{name}'
+
+    def _export(self):
+        metrics.set_gauge(self._metric('limit'), round(self.limit, 2))
+        metrics.set_gauge(self._metric('inflight'), self.inflight)
+        metrics.set_gauge(self._metric('waiting'), len(self._waiters))
+        metrics.set_gauge(self._metric('error_rate'), round(self._error_rate(), 4))
+        metrics.set_gauge(self._metric('state'), STATE_VALUES[self.state])
+
+    def summary(self):
+        """当前状态的简要描述，用于日志"""
+        with self._lock:
+            return (f"{self.name} {self.state} 并发上限 {self.limit:.1f} 进行中 {self.inflight} "
+                    f"排队 {len(self._waiters)} 错误率 {self._error_rate():.0%}")
+
+    def _error_rate(self):
+        if not self._outcomes:
+            return 0.0
+        return sum(1 for _, ok in self._outcomes if not ok) / len(self._outcomes)
+
+    def _admit(self):
+        """在锁内判断能否放行：True 放行，False 熔断降级，None 需要等待并发名额"""
+        if self.state == OPEN:
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            self.state = HALF_OPEN
+            self._probing = False
+            logger.info(f"{self.name} 熔断冷却结束，放行探测请求")
+        if self.state == HALF_OPEN:
+            if self._probing:
+                return False
+            self._probing = True
+        elif self.inflight >= int(self.limit):
+            return None
+        self.inflight += 1
+        self._export()
+        return True
+
+    def _shed(self, reason):
+        metrics.inc(self._metric('shed'))
+        logger.warning(f"{self.name} 调用被降级（{reason}），当前并发上限 {self.limit:.1f}，进行中 {self.inflight}")
+        return False
+
+    def acquire(self, timeout=None):
+        """同步申请一次调用名额，返回 False 时调用方应降级"""
+        deadline = time.monotonic() + (self.max_wait if timeout is None else timeout)
+        with self._cond:
+            while True:
+                admitted = self._admit()
+                if admitted is not None:
+                    return admitted or self._shed(self.state)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return self._shed('排队超时')
+                self._cond.wait(remaining)
+
+    async def aacquire(self, timeout=None):
+        """异步申请一次调用名额，返回 False 时调用方应降级"""
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + (self.max_wait if timeout is None else timeout)
+        while True:
+            with self._lock:
+                admitted = self._admit()
+                if admitted is not None:
+                    return admitted or self._shed(self.state)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return self._shed('排队超时')
+                waiter = (loop, loop.create_future())
+                self._waiters.append(waiter)
+                self._export()
+            try:
+                await asyncio.wait_for(waiter[1], remaining)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                with self._lock:
+                    self._waiters.remove(waiter)
+                    self._export()
+
+    def release(self, latency=None, ok=True):
+        """调用结束：记录耗时与结果，调整并发上限与熔断状态
+
+        latency 为 None 表示调用被取消，只归还名额，不计入统计
+        """
+        now = time.monotonic()
+        with self._lock:
+            self.inflight -= 1
+            if latency is None:
+                self._probing = False
+            else:
+                self._record(now, latency, ok)
+            self._export()
+            self._cond.notify_all()
+            for loop, future in self._waiters:
+                loop.call_soon_threadsafe(_wake, future)
+        if latency is not None:
+            metrics.observe(self._metric('latency'), latency)
+
+    def _record(self, now, latency, ok):
+        self._outcomes.append((now, ok))
+        while self._outcomes and now - self._outcomes[0][0] > self.window:
+            self._outcomes.popleft()
+
+        # AIMD：成功且未超时时加性增加，失败或超时时乘性减小
+        if ok and latency <= self.latency_target:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        else:
+            self.limit = max(self.min_limit, self.limit * self.backoff_ratio)
+
+        if ok:
+            self._consecutive_failures = 0
+            if self.state == HALF_OPEN:
+                self.state = CLOSED
+                self._probing = False
+                self._outcomes.clear()
+                logger.info(f"{self.name} 探测成功，熔断器关闭")
+            return
+        self._consecutive_failures += 1
+        if self.state == OPEN:
+            return
+        if (self.state == HALF_OPEN
+                or self._consecutive_failures >= self.failure_threshold
+                or (len(self._outcomes) >= self.min_calls and self._error_rate() >= self.error_rate_threshold)):
+            self.state = OPEN
+            self._opened_at = now
+            self._probing = False
+            metrics.inc(self._metric('trips'))
+            logger.error(f"{self.name} 熔断器打开：连续失败 {self._consecutive_failures} 次，"
+                         f"错误率 {self._error_rate():.0%}，{self.reset_timeout:.0f} 秒后探测")
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
@@ -0,0 +1,139 @@
+"""
+失败重试与死信队列
+
+消息处理失败时不再立即放回队列：
+- 信封中的 attempts 记录已失败次数，失败后按指数退避（带抖动）写入延迟重试 ZSET
+  xianyu:retry（成员为信封，分值为重试时间），到期后由重试任务放回消息队列
+- 失败次数达到上限，或信封本身无法解析时，写入死信列表 xianyu:dead_letters，
+  可通过 dlq_admin.py 查看、重新入队或清空
+"""
+import json
+import time
+import uuid
+import random
+from loguru import logger
+import metrics
+
+
+class RetryQueue:
+    """消息队列的延迟重试与死信"""
+
+    def __init__(self, redis_client, queue, retry_key='xianyu:retry', dead_key='xianyu:dead_letters',
+                 max_attempts=5, base_delay=1.0, max_delay=300.0):
+        """
+        Args:
+            redis_client: Redis客户端（decode_responses=True）
+            queue: 消息队列（message_queue.LaneQueue），重试时放回原通道
+            retry_key: 延迟重试 ZSET 键名
+            dead_key: 死信列表键名
+            max_attempts: 最多处理次数，达到后进入死信
+            base_delay: 首次重试的等待秒数，之后每次翻倍
+            max_delay: 重试等待上限（秒）
+        """
+        self.redis_client = redis_client
+        self.queue = queue
+        self.retry_key = retry_key
+        self.dead_key = dead_key
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def backoff(self, attempts):
+        """第 attempts 次失败后的等待秒数"""
+        delay = min(self.max_delay, self.base_delay * (2 ** (attempts - 1)))
+        return delay * random.uniform(0.5, 1.0)
+
+    def fail(self, handle, payload, error):
+        """处理失败：确认原消息，并安排重试或写入死信
+
+        Returns:
+            str: 'retry' 或 'dead'
+        """
+        try:
+            envelope = json.loads(payload)
+            if not isinstance(envelope, dict):
+                raise ValueError('信封不是JSON对象')
+        except ValueError as e:
+            envelope = {'raw': payload}
+            error = f"无法解析的消息: {e}"
+            attempts = self.max_attempts
+        else:
+            attempts = envelope.get('attempts', 0) + 1
+            envelope['attempts'] = attempts
+            envelope['last_error'] = str(error)
+
+        pipe = self.redis_client.pipeline()
+        self.queue.ack_to(pipe, handle)
+        if attempts >= self.max_attempts:
+            pipe.lpush(self.dead_key, json.dumps({
+                'envelope': envelope,
+                'error': str(error),
+                'attempts': attempts,
+                'failed_at': time.time(),
+            }, ensure_ascii=False))
+            pipe.execute()
+            metrics.inc('queue.dead_letters')
+            self.update_depth()
+            logger.error(f"消息处理失败 {attempts} 次，已写入死信队列: {error}")
+            return 'dead'
+
+        # 重试ID保证相同内容的消息在 ZSET 中是不同成员
+        envelope['retry_id'] = uuid.uuid4().hex
+        delay = self.backoff(attempts)
+        pipe.zadd(self.retry_key, {json.dumps(envelope, ensure_ascii=False): time.time() + delay})
+        pipe.execute()
+        metrics.inc('queue.retries')
+        logger.warning(f"消息处理失败（第 {attempts} 次），{delay:.1f} 秒后重试: {error}")
+        return 'retry'
+
+    def move_due(self, now=None, limit=100):
+        """把到期的重试消息放回消息队列，返回放回的条数"""
+        members = self.redis_client.zrangebyscore(self.retry_key, '-inf', now or time.time(), start=0, num=limit)
+        moved = 0
+        for member in members:
+            # ZREM 成功的调用者负责放回，多个进程同时搬运时不会重复
+            if self.redis_client.zrem(self.retry_key, member):
+                self.queue.push(member, lane=json.loads(member).get('lane'))
+                moved += 1
+        return moved
+
+    def next_due(self):
+        entries = self.redis_client.zrange(self.retry_key, 0, 0, withscores=True)
+        return entries[0][1] if entries else None
+
+    def depth(self):
+        return self.redis_client.llen(self.dead_key)
+
+    def update_depth(self):
+        metrics.set_gauge('queue.dlq_depth', self.depth())
+        metrics.set_gauge('queue.retry_depth', self.redis_client.zcard(self.retry_key))
+
+    def list_dead(self, limit=20):
+        """最近的死信，最新的在前"""
+        return [json.loads(item) for item in self.redis_client.lrange(self.dead_key, 0, limit - 1)]
+
+    def requeue_dead(self, limit=None):
+        """把死信（从最早的开始）重新放回消息队列，失败次数清零，返回放回的条数"""
+        requeued = 0
+        while limit is None or requeued < limit:
+            item = self.redis_client.rpop(self.dead_key)
+            if item is None:
+                break
+            envelope = json.loads(item)['envelope']
+            if 'raw' in envelope:
+                payload = envelope['raw']
+            else:
+                envelope.pop('attempts', None)
+                envelope.pop('last_error', None)
+                envelope.pop('retry_id', None)
+                payload = json.dumps(envelope, ensure_ascii=False)
+            self.queue.push(payload, lane=envelope.get('lane'))
+            requeued += 1
+        return requeued
+
+    def purge_dead(self):
+        """清空死信，返回清除的条数"""
+        pipe = self.redis_client.pipeline()
+        pipe.llen(self.dead_key)
+        pipe.delete(self.dead_key)
+        return pipe.execute()[0]
@@ -0,0 +1,238 @@
+"""
+会话防抖调度
+
+每个会话（order_id）收到一段连续消息的第一条时，在 ZSET xianyu:debounce 中写入
+order_id -> 到期时间；批量回复任务只取已到期的成员，并休眠到下一个到期时间，
+调度开销只与到期会话数有关，与 Redis 中的键数量无关。
+
+所有状态都在 Redis 中，多个进程/主机可以同时运行批量回复任务：
+- 处理会话前先获取租约 xianyu:debounce_lease:{order_id}（SET NX PX），
+  值为 INCR 生成的递增令牌（fencing token）
+- 获取租约时把到期时间推迟到租约过期之后，持有者崩溃时会话会在租约过期后重新到期
+- 租约被他人持有时推迟 lease_retry 秒再试
+- 持有者校验令牌后把会话消息移入处理中列表 xianyu:debounce_processing:{order_id}，
+  发送成功后才删除；持有者崩溃时消息留在处理中列表，下一个持有者与新消息合并后重新处理
+- 保存和发送前原子地校验令牌并续期租约，租约已过期并被他人获取时放弃本次结果，
+  消息留给新的持有者；完成时同样校验令牌后删除处理中列表
+
+脚本在进程内存储（memory_store）中由对应的 Python 实现执行。
+"""
+import json
+from memory_store import lua_equivalent
+
+# 获取租约：KEYS = [租约键, 令牌计数键, 防抖ZSET]，ARGV = [租约毫秒, 成功后重试时间, 失败后重试时间, order_id]
+_ACQUIRE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('ZADD', KEYS[3], 'XX', ARGV[3], ARGV[4])
+    return false
+end
+local token = redis.call('INCR', KEYS[2])
+redis.call('SET', KEYS[1], token, 'PX', ARGV[1])
+redis.call('ZADD', KEYS[3], 'XX', ARGV[2], ARGV[4])
+return token
+"""
+
+# 取出会话消息：KEYS = [会话消息列表, 处理中列表, 租约键]，ARGV = [令牌]
+# 令牌不符时返回 false；否则把新消息移入处理中列表（上一个持有者未完成的消息在前），
+# 按 timestamp 升序返回处理中列表的全部消息（相同时按写入顺序）。到期登记保留到完成时再移除
+_DRAIN_SCRIPT = """
+if redis.call('GET', KEYS[3]) ~= ARGV[1] then
+    return false
+end
+local fresh = redis.call('LRANGE', KEYS[1], 0, -1)
+for i = #fresh, 1, -1 do
+    redis.call('LPUSH', KEYS[2], fresh[i])
+end
+redis.call('DEL', KEYS[1])
+redis.call('EXPIRE', KEYS[2], 86400)
+local items = redis.call('LRANGE', KEYS[2], 0, -1)
+local entries = {}
+for i, raw in ipairs(items) do
+    local ok, msg = pcall(cjson.decode, raw)
+    local ts = ok and type(msg) == 'table' and tonumber(msg['timestamp']) or 0
+    entries[i] = {ts, i, raw}
+end
+table.sort(entries, function(a, b)
+    if a[1] == b[1] then
+        return a[2] > b[2]
+    end
+    return a[1] < b[1]
+end)
+local result = {}
+for i, entry in ipairs(entries) do
+    result[i] = entry[3]
+end
+return result
+"""
+
+# 校验并续期租约：KEYS = [租约键]，ARGV = [令牌, 租约毫秒]
+_RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# 完成处理：KEYS = [处理中列表, 会话消息列表, 防抖ZSET, 租约键]，ARGV = [令牌, 新消息的到期时间, order_id]
+# 令牌相符时删除处理中列表；处理期间有新消息则重新登记到期时间，否则移除到期登记
+_COMPLETE_SCRIPT = """
+if redis.call('GET', KEYS[4]) ~= ARGV[1] then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+if redis.call('LLEN', KEYS[2]) > 0 then
+    redis.call('ZADD', KEYS[3], ARGV[2], ARGV[3])
+else
+    redis.call('ZREM', KEYS[3], ARGV[3])
+end
+return 1
+"""
+
+# 释放租约：只删除仍属于自己的租约
+_RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+@lua_equivalent(_ACQUIRE_SCRIPT)
+def _acquire_in_memory(store, keys, args):
+    lease_key, fence_key, key = keys
+    ttl_ms, due_time, retry_time, order_id = args
+    if store.exists(lease_key):
+        store.zadd(key, {order_id: retry_time}, xx=True)
+        return None
+    token = store.incr(fence_key)
+    store.set(lease_key, token, px=int(ttl_ms))
+    store.zadd(key, {order_id: due_time}, xx=True)
+    return token
+
+
+@lua_equivalent(_DRAIN_SCRIPT)
+def _drain_in_memory(store, keys, args):
+    list_key, processing_key, lease_key = keys
+    if store.get(lease_key) != str(args[0]):
+        return None
+    for raw in reversed(store.lrange(list_key, 0, -1)):
+        store.lpush(processing_key, raw)
+    store.delete(list_key)
+    store.expire(processing_key, 86400)
+    items = store.lrange(processing_key, 0, -1)
+    entries = []
+    for i, raw in enumerate(items):
+        try:
+            ts = float(json.loads(raw).get('timestamp') or 0)
+        except (ValueError, TypeError, AttributeError):
+            ts = 0
+        entries.append((ts, -i, raw))
+    entries.sort(key=lambda entry: entry[:2])
+    return [raw for _, _, raw in entries]
+
+
+@lua_equivalent(_RENEW_SCRIPT)
+def _renew_in_memory(store, keys, args):
+    if store.get(keys[0]) == str(args[0]):
+        return store.pexpire(keys[0], int(args[1]))
+    return 0
+
+
+@lua_equivalent(_COMPLETE_SCRIPT)
+def _complete_in_memory(store, keys, args):
+    processing_key, list_key, key, lease_key = keys
+    token, due_time, order_id = args
+    if store.get(lease_key) != str(token):
+        return 0
+    store.delete(processing_key)
+    if store.llen(list_key) > 0:
+        store.zadd(key, {order_id: due_time})
+    else:
+        store.zrem(key, order_id)
+    return 1
+
+
+@lua_equivalent(_RELEASE_SCRIPT)
+def _release_in_memory(store, keys, args):
+    if store.get(keys[0]) == str(args[0]):
+        return store.delete(keys[0])
+    return 0
+
+
+class DebounceScheduler:
+    """基于 Redis ZSET 的防抖到期索引与会话租约"""
+
+    def __init__(self, redis_client, key='xianyu:debounce', lease_ttl=60, lease_retry=1):
+        """
+        Args:
+            redis_client: Redis客户端（decode_responses=True）
+            key: 防抖 ZSET 键名
+            lease_ttl: 会话租约时长（秒），应大于一次生成并发送回复的耗时
+            lease_retry: 租约被占用时推迟多少秒再试
+        """
+        self.redis_client = redis_client
+        self.key = key
+        self.lease_ttl = lease_ttl
+        self.lease_retry = lease_retry
+        self.fence_key = f"{key}_fence"
+        self._acquire = redis_client.register_script(_ACQUIRE_SCRIPT)
+        self._release = redis_client.register_script(_RELEASE_SCRIPT)
+        self._drain = redis_client.register_script(_DRAIN_SCRIPT)
+        self._renew = redis_client.register_script(_RENEW_SCRIPT)
+        self._complete = redis_client.register_script(_COMPLETE_SCRIPT)
+
+    def lease_key(self, order_id):
+        return f"{self.key}_lease:{order_id}"
+
+    def processing_key(self, order_id):
+        return f"{self.key}_processing:{order_id}"
+
+    def schedule_to(self, pipe, order_id, due_time):
+        """在 Redis 管道中登记到期时间，已登记的会话保持原到期时间"""
+        pipe.zadd(self.key, {order_id: due_time}, nx=True)
+
+    def schedule(self, order_id, due_time):
+        self.redis_client.zadd(self.key, {order_id: due_time}, nx=True)
+
+    def reschedule(self, order_id, due_time):
+        """重新登记到期时间（覆盖原到期时间）"""
+        self.redis_client.zadd(self.key, {order_id: due_time})
+
+    def drain(self, order_id, list_key, token):
+        """校验令牌后把会话的新消息移入处理中列表，返回处理中的全部消息
+
+        Returns:
+            list: 按 timestamp 升序排列的原始消息字符串；令牌已失效时返回 None
+        """
+        return self._drain(keys=[list_key, self.processing_key(order_id), self.lease_key(order_id)], args=[token])
+
+    def complete(self, order_id, list_key, token, next_due):
+        """处理完成：校验令牌后删除处理中列表，处理期间的新消息在 next_due 到期，返回是否成功"""
+        return bool(self._complete(
+            keys=[self.processing_key(order_id), list_key, self.key, self.lease_key(order_id)],
+            args=[token, next_due, order_id]
+        ))
+
+    def due(self, now, limit=100):
+        """已到期的会话，按到期时间排序"""
+        return self.redis_client.zrangebyscore(self.key, '-inf', now, start=0, num=limit)
+
+    def next_due(self):
+        """最早的到期时间，没有待处理会话时返回 None"""
+        entries = self.redis_client.zrange(self.key, 0, 0, withscores=True)
+        return entries[0][1] if entries else None
+
+    def acquire(self, order_id, now):
+        """获取会话租约，成功返回令牌，被他人持有时返回 None"""
+        token = self._acquire(
+            keys=[self.lease_key(order_id), self.fence_key, self.key],
+            args=[int(self.lease_ttl * 1000), now + self.lease_ttl, now + self.lease_retry, order_id]
+        )
+        return int(token) if token else None
+
+    def renew(self, order_id, token):
+        """原子地校验令牌并把租约续期 lease_ttl，租约已不属于该令牌时返回 False"""
+        return bool(self._renew(keys=[self.lease_key(order_id)], args=[token, int(self.lease_ttl * 1000)]))
+
+    def release(self, order_id, token):
+        self._release(keys=[self.lease_key(order_id)], args=[token])
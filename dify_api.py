@@ -6,7 +6,49 @@ from dotenv import load_dotenv
 # 加载环境变量
 load_dotenv()
 
-def send_message_to_dify(api_key, query, conversation_id="", user_id="abc-123", image_url=None, order_id=None):
+# 流式模式下携带回复片段的事件
+ANSWER_EVENTS = ('message', 'agent_message')
+
+def parse_sse_line(line):
+    """
+    解析一行 SSE 数据
+    
+    参数:
+        line (bytes | str): 一行响应内容
+    
+    返回:
+        dict: data 行中的事件；空行、注释和 ping 等非 data 行返回 None
+    """
+    if isinstance(line, bytes):
+        line = line.decode('utf-8')
+    line = line.strip()
+    if not line.startswith('data:'):
+        return None
+    data = line[5:].strip()
+    if not data:
+        return None
+    return json.loads(data)
+
+def iter_dify_events(response):
+    """
+    逐个读取流式响应中的事件，直到 message_end 或 error
+    
+    参数:
+        response: 使用 stream=True 发送的 requests 响应对象
+    
+    返回:
+        事件字典的迭代器
+    """
+    for line in response.iter_lines():
+        event = parse_sse_line(line)
+        if event is None:
+            continue
+        yield event
+        if event.get('event') in ('message_end', 'error'):
+            break
+
+def send_message_to_dify(api_key, query, conversation_id="", user_id="abc-123", image_url=None, order_id=None,
+                         response_mode="blocking"):
     """
     向 Dify.ai API 发送消息
     
@@ -17,11 +59,12 @@ def send_message_to_dify(api_key, query, conversation_id="", user_id="abc-123",
         user_id (str, 可选): 用户ID，默认为 "abc-123"
         image_url (str, 可选): 要包含的图片URL，默认为 None
         order_id (str, 可选): 订单ID，默认为 None
+        response_mode (str, 可选): "blocking" 或 "streaming"，流式模式下用 iter_dify_events 读取响应
     
     返回:
         API 的响应对象
     """
-    url = "http://127.0.0.1/v1/chat-messages"
+    url = f"{os.getenv('DIFY_BASE_URL', 'http://127.0.0.1/v1').rstrip('/')}/chat-messages"
     
     headers = {
         "Authorization": f"Bearer {api_key}",
@@ -34,7 +77,7 @@ def send_message_to_dify(api_key, query, conversation_id="", user_id="abc-123",
             "order_id": order_id
         },
         "query": query,
-        "response_mode": "blocking",
+        "response_mode": response_mode,
         "conversation_id": conversation_id,
         "user": user_id,
         "files": [
@@ -57,7 +100,7 @@ def send_message_to_dify(api_key, query, conversation_id="", user_id="abc-123",
         ]
     
     # 发送POST请求
-    response = requests.post(url, headers=headers, json=payload)
+    response = requests.post(url, headers=headers, json=payload, stream=response_mode == "streaming", timeout=(5, 60))
     return response
 
 # 使用示例
@@ -74,14 +117,21 @@ if __name__ == "__main__":
     # 示例图片URL
     image_url = "https://cloud.dify.ai/logo/logo-site.png"
     
-    # 发送请求
+    # 发送请求（流式）
     response = send_message_to_dify(
         api_key=API_KEY,
         query=query,
         image_url=image_url,
-        order_id="48920775354"
+        order_id="48920775354",
+        response_mode="streaming"
     )
     
-    # 打印响应
+    # 逐段打印响应
     print(f"状态码: {response.status_code}")
-    print(f"响应内容: {response.text}") 
\ No newline at end of file
+    for event in iter_dify_events(response):
+        if event.get('event') in ANSWER_EVENTS:
+            print(event.get('answer', ''), end='', flush=True)
+        elif event.get('event') == 'message_end':
+            print(f"\n响应结束: {json.dumps(event.get('metadata', {}), ensure_ascii=False)}")
+        elif event.get('event') == 'error':
+            print(f"\n响应错误: {event.get('message')}") 
\ No newline at end of file
@@ -0,0 +1,36 @@
+"""
+Dify 会话映射
+
+(user_id, order_id) -> Dify conversation_id，保存在 Redis 中并带有过期时间：
+- 首次回复时从 Dify 响应中记录会话ID，之后的回复沿用该会话，由 Dify 保存对话历史
+- 存在映射时不再拼接 MySQL 中的历史消息
+- 每次使用后刷新过期时间，长时间无消息的会话重新开始
+"""
+
+
+class DifyConversations:
+    """Dify 会话ID的存取"""
+
+    def __init__(self, redis_client, key_prefix='xianyu:dify_conversation', ttl=7 * 86400):
+        """
+        Args:
+            redis_client: Redis客户端（decode_responses=True）
+            key_prefix: 键名前缀
+            ttl: 映射的过期时间（秒）
+        """
+        self.redis_client = redis_client
+        self.key_prefix = key_prefix
+        self.ttl = ttl
+
+    def _key(self, user_id, order_id):
+        return f"{self.key_prefix}:{user_id}:{order_id}"
+
+    def get(self, user_id, order_id):
+        return self.redis_client.get(self._key(user_id, order_id))
+
+    def save(self, user_id, order_id, conversation_id):
+        """记录会话ID并刷新过期时间"""
+        self.redis_client.set(self._key(user_id, order_id), conversation_id, ex=self.ttl)
+
+    def forget(self, user_id, order_id):
+        self.redis_client.delete(self._key(user_id, order_id))
@@ -0,0 +1,52 @@
+"""
+死信队列管理
+
+python dlq_admin.py stats            # 死信数量与等待重试的数量
+python dlq_admin.py list [-n 20]     # 查看最近的死信
+python dlq_admin.py requeue [-n N]   # 从最早的开始重新入队（默认全部），失败次数清零
+python dlq_admin.py purge            # 清空死信
+
+使用与主程序相同的 REDIS_* 与 XIANYU_QUEUE_BACKEND 环境变量。
+"""
+import os
+import json
+import argparse
+from datetime import datetime
+from dotenv import load_dotenv
+from redis_client import create_redis
+from message_queue import create_lane_queue
+from dead_letter import RetryQueue
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description='死信队列管理')
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('stats', help='死信数量与等待重试的数量')
+    list_parser = sub.add_parser('list', help='查看最近的死信')
+    list_parser.add_argument('-n', type=int, default=20, help='显示条数')
+    requeue_parser = sub.add_parser('requeue', help='重新入队')
+    requeue_parser.add_argument('-n', type=int, default=None, help='重新入队的条数，默认全部')
+    sub.add_parser('purge', help='清空死信')
+    args = parser.parse_args()
+
+    redis_client = create_redis()
+    queue = create_lane_queue(redis_client, backend=os.getenv('XIANYU_QUEUE_BACKEND', 'list'))
+    retry_queue = RetryQueue(redis_client, queue)
+
+    if args.command == 'stats':
+        print(f"死信: {retry_queue.depth()}")
+        print(f"等待重试: {redis_client.zcard(retry_queue.retry_key)}")
+    elif args.command == 'list':
+        for record in retry_queue.list_dead(args.n):
+            failed_at = datetime.fromtimestamp(record['failed_at']).strftime('%Y-%m-%d %H:%M:%S')
+            print(f"[{failed_at}] 失败 {record['attempts']} 次: {record['error']}")
+            print(f"  {json.dumps(record['envelope'], ensure_ascii=False)[:500]}")
+    elif args.command == 'requeue':
+        print(f"已重新入队 {retry_queue.requeue_dead(args.n)} 条")
+    elif args.command == 'purge':
+        print(f"已清空 {retry_queue.purge_dead()} 条")
+
+
+if __name__ == '__main__':
+    main()
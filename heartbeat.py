@@ -3,8 +3,35 @@ import json
 import asyncio
 from loguru import logger
 from utils.xianyu_utils import generate_mid, generate_uuid, decrypt
+from outbound import PRIORITY_HEARTBEAT
+import metrics
+
+
+class RttEstimator:
+    """心跳往返时间估计（与 TCP 相同的平滑算法）"""
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = 0.0
+        self.min_rtt = None
+
+    def update(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+
+    @property
+    def degraded(self):
+        """平滑RTT明显高于本连接的最小RTT"""
+        return self.srtt is not None and self.srtt > 3 * self.min_rtt + 0.05
+
+
 async def send_heartbeat(self, ws):
-    """发送心跳包并等待响应"""
+    """心跳包入出站队列，返回心跳mid；发出后 pending_heartbeats[mid] 记录发送时间"""
     try:
         heartbeat_mid = generate_mid()
         heartbeat_msg = {
@@ -13,47 +40,106 @@ async def send_heartbeat(self, ws):
                 "mid": heartbeat_mid
             }
         }
-        await ws.send(json.dumps(heartbeat_msg))
-        self.last_heartbeat_time = time.time()
-        logger.debug("心跳包已发送")
+        # 发送时间在写任务实际发出后才记录，RTT 不包含出站队列的等待时间
+        self.pending_heartbeats[heartbeat_mid] = None
+
+        def on_sent():
+            if heartbeat_mid in self.pending_heartbeats:
+                self.pending_heartbeats[heartbeat_mid] = time.monotonic()
+                self.last_heartbeat_time = time.time()
+                logger.debug("心跳包已发送")
+                if self.heartbeat_event:
+                    self.heartbeat_event.set()
+
+        await self.outbound.put(json.dumps(heartbeat_msg), PRIORITY_HEARTBEAT, on_sent=on_sent)
         return heartbeat_mid
     except Exception as e:
         logger.error(f"发送心跳包失败: {e}")
         raise
 
+def _heartbeat_timeout(self):
+    """超时取 k×RTT，限制在 [heartbeat_min_timeout, heartbeat_timeout] 内；还没有RTT样本时用 heartbeat_timeout"""
+    rtt = self.heartbeat_rtt
+    if rtt.srtt is None:
+        return self.heartbeat_timeout
+    timeout = self.heartbeat_rtt_multiplier * rtt.srtt + 4 * rtt.rttvar
+    return min(self.heartbeat_timeout, max(self.heartbeat_min_timeout, timeout))
+
+def _heartbeat_interval(self):
+    """RTT 变差时缩短心跳间隔，尽早发现断线"""
+    if self.heartbeat_rtt.degraded:
+        return self.heartbeat_min_interval
+    return self.heartbeat_interval
+
 async def heartbeat_loop(self, ws):
-    """心跳维护循环"""
+    """心跳维护循环：发送后等待对应mid的响应，超时即关闭连接，否则休眠到下一次心跳"""
+    self.pending_heartbeats.clear()
+    self.heartbeat_rtt = RttEstimator()
+    self.heartbeat_event = asyncio.Event()
     while True:
         try:
-            current_time = time.time()
-            
-            # 检查是否需要发送心跳
-            if current_time - self.last_heartbeat_time >= self.heartbeat_interval:
-                await self.send_heartbeat(ws)
-            
-            # 检查上次心跳响应时间，如果超时则认为连接已断开
-            if (current_time - self.last_heartbeat_response) > (self.heartbeat_interval + self.heartbeat_timeout):
-                logger.warning("心跳响应超时，可能连接已断开")
+            mid = await self.send_heartbeat(ws)
+
+            # 等写任务实际发出后才开始计时；连接断开时本任务会被取消
+            while self.pending_heartbeats.get(mid, 0) is None:
+                self.heartbeat_event.clear()
+                await self.heartbeat_event.wait()
+            sent_at = self.pending_heartbeats.get(mid) or time.monotonic()
+            deadline = sent_at + _heartbeat_timeout(self)
+
+            # 等待该mid的响应（由 handle_heartbeat_response 唤醒）
+            while mid in self.pending_heartbeats:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.heartbeat_event.clear()
+                try:
+                    await asyncio.wait_for(self.heartbeat_event.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+
+            if self.pending_heartbeats.pop(mid, None) is not None:
+                metrics.inc('heartbeat.timeout')
+                logger.warning(f"心跳响应超时（{deadline - sent_at:.2f} 秒），可能连接已断开")
+                # 主动关闭连接，由 main() 的重连逻辑重新建立会话
+                await ws.close()
                 break
-            
-            await asyncio.sleep(1)
+
+            interval = _heartbeat_interval(self)
+            metrics.set_gauge('heartbeat.interval', interval)
+            await asyncio.sleep(max(0.0, sent_at + interval - time.monotonic()))
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
             logger.error(f"心跳循环出错: {e}")
             break
 
 async def handle_heartbeat_response(self, message_data):
-    """处理心跳响应"""
+    """处理心跳响应：只有mid与已发送心跳匹配的响应才算"""
     try:
         if (
             isinstance(message_data, dict)
-            and "headers" in message_data
-            and "mid" in message_data["headers"]
-            and "code" in message_data
-            and message_data["code"] == 200
+            and message_data.get("code") == 200
+            and isinstance(message_data.get("headers"), dict)
         ):
+            mid = message_data["headers"].get("mid")
+            if mid not in self.pending_heartbeats:
+                return False
+            sent_at = self.pending_heartbeats.pop(mid)
+            if sent_at is None:
+                # 写任务尚未回调就收到了响应，不计入RTT
+                if self.heartbeat_event:
+                    self.heartbeat_event.set()
+                return True
+            rtt = time.monotonic() - sent_at
+            self.heartbeat_rtt.update(rtt)
+            metrics.observe('heartbeat.rtt', rtt)
+            metrics.set_gauge('heartbeat.srtt', self.heartbeat_rtt.srtt)
             self.last_heartbeat_response = time.time()
-            logger.debug("收到心跳响应")
+            if self.heartbeat_event:
+                self.heartbeat_event.set()
+            logger.debug(f"收到心跳响应，RTT {rtt * 1000:.1f} ms")
             return True
     except Exception as e:
         logger.error(f"处理心跳响应出错: {e}")
-    return False 
\ No newline at end of file
+    return False
@@ -0,0 +1,615 @@
+"""
+进程内存储后端
+
+实现本项目用到的 redis-py 命令子集（字符串、哈希、列表、有序集合、Stream 消费者组、
+管道和脚本），数据保存在进程内的字典中，语义与 Redis 保持一致：
+- 键支持 TTL，访问时惰性过期，写入时定期清理
+- 管道在一把锁内顺序执行，等同于 MULTI/EXEC 的原子性
+- Lua 脚本没有解释器，由定义脚本的模块通过 lua_equivalent() 注册等价的 Python 实现，
+  同样在锁内原子执行
+
+单进程部署时设置 XIANYU_STORE_BACKEND=memory 即可不依赖 Redis，数据随进程退出丢失。
+"""
+import time
+import fnmatch
+import threading
+import itertools
+from collections import OrderedDict, deque
+from redis.exceptions import ResponseError
+
+_WRONGTYPE = 'WRONGTYPE Operation against a key holding the wrong kind of value'
+
+# Lua 脚本源码 -> 等价的 Python 实现 fn(store, keys, args)
+SCRIPTS = {}
+
+
+def lua_equivalent(script):
+    """注册 Lua 脚本在进程内存储中的等价实现"""
+    def decorator(fn):
+        SCRIPTS[script] = fn
+        return fn
+    return decorator
+
+
+def _str(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _parse_id(stream_id):
+    if isinstance(stream_id, tuple):
+        return stream_id
+    ms, _, seq = str(stream_id).partition('-')
+    return int(ms), int(seq or 0)
+
+
+def _format_id(stream_id):
+    return f"{stream_id[0]}-{stream_id[1]}"
+
+
+def _score_bound(value):
+    """解析 ZRANGEBYSCORE 的边界，返回 (分值, 是否开区间)"""
+    if isinstance(value, (int, float)):
+        return float(value), False
+    value = str(value)
+    if value in ('-inf', '+inf', 'inf'):
+        return float(value), False
+    if value.startswith('('):
+        return float(value[1:]), True
+    return float(value), False
+
+
+class _List(deque):
+    pass
+
+
+class _Hash(dict):
+    pass
+
+
+class _ZSet(dict):
+    pass
+
+
+class _Group:
+    def __init__(self, last_id):
+        self.last_id = last_id
+        self.pending = OrderedDict()  # id -> [consumer, 投递时间ms, 投递次数]
+
+
+class _Stream:
+    def __init__(self):
+        self.entries = OrderedDict()  # id -> fields
+        self.last_id = (0, 0)
+        self.groups = {}
+
+
+class MemoryRedis:
+    """线程安全的进程内 Redis 替代实现（decode_responses=True 语义）"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._data = {}
+        self._expires = {}
+        self._writes = 0
+
+    # ---- 键空间 ----
+
+    def _alive(self, key):
+        deadline = self._expires.get(key)
+        if deadline is not None and deadline <= time.time():
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+            return False
+        return key in self._data
+
+    def _get(self, key, kind):
+        if not self._alive(key):
+            return None
+        value = self._data[key]
+        if not isinstance(value, kind):
+            raise ResponseError(_WRONGTYPE)
+        return value
+
+    def _get_or_create(self, key, kind):
+        value = self._get(key, kind)
+        if value is None:
+            value = self._data[key] = kind()
+        self._wrote()
+        return value
+
+    def _wrote(self):
+        # 每 1000 次写入清理一次已过期的键
+        self._writes += 1
+        if self._writes % 1000 == 0:
+            now = time.time()
+            for key, deadline in list(self._expires.items()):
+                if deadline <= now:
+                    self._data.pop(key, None)
+                    self._expires.pop(key, None)
+
+    def _cleanup(self, key):
+        """集合类型为空时删除键"""
+        if key in self._data and not isinstance(self._data[key], (str, _Stream)) and not self._data[key]:
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+
+    def ping(self):
+        return True
+
+    def close(self):
+        pass
+
+    def flushdb(self):
+        with self._lock:
+            self._data.clear()
+            self._expires.clear()
+            return True
+
+    def exists(self, *keys):
+        with self._lock:
+            return sum(1 for key in keys if self._alive(key))
+
+    def delete(self, *keys):
+        with self._lock:
+            removed = 0
+            for key in keys:
+                if self._alive(key):
+                    removed += 1
+                self._data.pop(key, None)
+                self._expires.pop(key, None)
+            return removed
+
+    def expire(self, key, seconds):
+        with self._lock:
+            if not self._alive(key):
+                return False
+            self._expires[key] = time.time() + seconds
+            return True
+
+    def pexpire(self, key, milliseconds):
+        return self.expire(key, milliseconds / 1000)
+
+    def ttl(self, key):
+        with self._lock:
+            if not self._alive(key):
+                return -2
+            deadline = self._expires.get(key)
+            return -1 if deadline is None else max(0, int(round(deadline - time.time())))
+
+    def keys(self, pattern='*'):
+        with self._lock:
+            return [key for key in list(self._data) if self._alive(key) and fnmatch.fnmatchcase(key, pattern)]
+
+    # ---- 字符串 ----
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key, str)
+
+    def set(self, key, value, ex=None, px=None, nx=False, xx=False):
+        with self._lock:
+            exists = self._alive(key)
+            if (nx and exists) or (xx and not exists):
+                return None
+            self._data[key] = _str(value)
+            self._expires.pop(key, None)
+            if ex is not None:
+                self._expires[key] = time.time() + ex
+            elif px is not None:
+                self._expires[key] = time.time() + px / 1000
+            self._wrote()
+            return True
+
+    def setex(self, key, seconds, value):
+        return self.set(key, value, ex=seconds)
+
+    def incr(self, key, amount=1):
+        with self._lock:
+            value = int(self._get(key, str) or 0) + amount
+            self._data[key] = str(value)
+            self._wrote()
+            return value
+
+    # ---- 哈希 ----
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        with self._lock:
+            items = dict(mapping or {})
+            if field is not None:
+                items[field] = value
+            hash_ = self._get_or_create(key, _Hash)
+            added = sum(1 for f in items if f not in hash_)
+            for f, v in items.items():
+                hash_[_str(f)] = _str(v)
+            return added
+
+    def hget(self, key, field):
+        with self._lock:
+            return (self._get(key, _Hash) or {}).get(field)
+
+    def hgetall(self, key):
+        with self._lock:
+            return dict(self._get(key, _Hash) or {})
+
+    def hdel(self, key, *fields):
+        with self._lock:
+            hash_ = self._get(key, _Hash) or {}
+            removed = sum(1 for f in fields if hash_.pop(f, None) is not None)
+            self._cleanup(key)
+            return removed
+
+    # ---- 列表（下标 0 为左端） ----
+
+    def lpush(self, key, *values):
+        with self._lock:
+            items = self._get_or_create(key, _List)
+            items.extendleft(_str(value) for value in values)
+            return len(items)
+
+    def rpush(self, key, *values):
+        with self._lock:
+            items = self._get_or_create(key, _List)
+            items.extend(_str(value) for value in values)
+            return len(items)
+
+    def lpop(self, key):
+        with self._lock:
+            items = self._get(key, _List)
+            if not items:
+                return None
+            value = items.popleft()
+            self._cleanup(key)
+            return value
+
+    def rpop(self, key):
+        with self._lock:
+            items = self._get(key, _List)
+            if not items:
+                return None
+            value = items.pop()
+            self._cleanup(key)
+            return value
+
+    def rpoplpush(self, src, dst):
+        with self._lock:
+            value = self.rpop(src)
+            if value is not None:
+                self.lpush(dst, value)
+            return value
+
+    def llen(self, key):
+        with self._lock:
+            return len(self._get(key, _List) or ())
+
+    def lrange(self, key, start, end):
+        with self._lock:
+            items = self._get(key, _List) or ()
+            length = len(items)
+            start = max(0, start + length if start < 0 else start)
+            end = min(length - 1, end + length if end < 0 else end)
+            if end < start:
+                return []
+            return list(itertools.islice(items, start, end + 1))
+
+    def ltrim(self, key, start, end):
+        with self._lock:
+            items = self._get(key, _List)
+            if items is None:
+                return True
+            self._data[key] = _List(self.lrange(key, start, end))
+            self._cleanup(key)
+            return True
+
+    def lrem(self, key, count, value):
+        with self._lock:
+            items = self._get(key, _List)
+            if not items:
+                return 0
+            value = _str(value)
+            ordered = list(items) if count >= 0 else list(reversed(items))
+            kept = []
+            removed = 0
+            for item in ordered:
+                if item == value and (count == 0 or removed < abs(count)):
+                    removed += 1
+                else:
+                    kept.append(item)
+            if removed:
+                self._data[key] = _List(kept if count >= 0 else reversed(kept))
+                self._cleanup(key)
+            return removed
+
+    # ---- 有序集合 ----
+
+    def zadd(self, key, mapping, nx=False, xx=False):
+        with self._lock:
+            zset = self._get(key, _ZSet)
+            if zset is None:
+                if xx:
+                    return 0
+                zset = self._get_or_create(key, _ZSet)
+            added = 0
+            for member, score in mapping.items():
+                member = _str(member)
+                exists = member in zset
+                if (nx and exists) or (xx and not exists):
+                    continue
+                zset[member] = float(score)
+                added += 0 if exists else 1
+            self._cleanup(key)
+            return added
+
+    def zrem(self, key, *members):
+        with self._lock:
+            zset = self._get(key, _ZSet) or {}
+            removed = sum(1 for m in members if zset.pop(_str(m), None) is not None)
+            self._cleanup(key)
+            return removed
+
+    def zscore(self, key, member):
+        with self._lock:
+            return (self._get(key, _ZSet) or {}).get(_str(member))
+
+    def zcard(self, key):
+        with self._lock:
+            return len(self._get(key, _ZSet) or {})
+
+    def _sorted(self, key):
+        return sorted((self._get(key, _ZSet) or {}).items(), key=lambda item: (item[1], item[0]))
+
+    def zrange(self, key, start, end, withscores=False):
+        with self._lock:
+            items = self._sorted(key)
+            length = len(items)
+            start = max(0, start + length if start < 0 else start)
+            end = end + length if end < 0 else end
+            items = items[start:end + 1]
+            return items if withscores else [member for member, _ in items]
+
+    def zrangebyscore(self, key, min, max, start=None, num=None, withscores=False):
+        with self._lock:
+            low, low_open = _score_bound(min)
+            high, high_open = _score_bound(max)
+            items = [
+                (member, score) for member, score in self._sorted(key)
+                if (score > low if low_open else score >= low) and (score < high if high_open else score <= high)
+            ]
+            if start is not None and num is not None:
+                items = items[start:] if num < 0 else items[start:start + num]
+            return items if withscores else [member for member, _ in items]
+
+    def zpopmin(self, key, count=1):
+        with self._lock:
+            items = self._sorted(key)[:count]
+            zset = self._get(key, _ZSet) or {}
+            for member, _ in items:
+                zset.pop(member, None)
+            self._cleanup(key)
+            return items
+
+    # ---- Stream ----
+
+    def xadd(self, name, fields, id='*', maxlen=None, approximate=True):
+        with self._lock:
+            stream = self._get_or_create(name, _Stream)
+            if id == '*':
+                ms = int(time.time() * 1000)
+                new_id = (ms, 0) if ms > stream.last_id[0] else (stream.last_id[0], stream.last_id[1] + 1)
+            else:
+                new_id = _parse_id(id)
+                if new_id <= stream.last_id:
+                    raise ResponseError('ERR The ID specified in XADD is equal or smaller than the target stream top item')
+            stream.last_id = new_id
+            stream.entries[new_id] = {_str(k): _str(v) for k, v in fields.items()}
+            if maxlen is not None:
+                while len(stream.entries) > maxlen:
+                    stream.entries.popitem(last=False)
+            return _format_id(new_id)
+
+    def xlen(self, name):
+        with self._lock:
+            stream = self._get(name, _Stream)
+            return len(stream.entries) if stream else 0
+
+    def xrange(self, name, min='-', max='+', count=None):
+        with self._lock:
+            stream = self._get(name, _Stream)
+            if not stream:
+                return []
+            low = (0, 0) if min == '-' else _parse_id(min)
+            high = (float('inf'), float('inf')) if max == '+' else _parse_id(max)
+            result = [(_format_id(i), dict(f)) for i, f in stream.entries.items() if low <= i <= high]
+            return result[:count] if count else result
+
+    def xdel(self, name, *ids):
+        with self._lock:
+            stream = self._get(name, _Stream)
+            if not stream:
+                return 0
+            return sum(1 for i in ids if stream.entries.pop(_parse_id(i), None) is not None)
+
+    def xgroup_create(self, name, groupname, id='$', mkstream=False):
+        with self._lock:
+            stream = self._get(name, _Stream)
+            if stream is None:
+                if not mkstream:
+                    raise ResponseError('ERR The XGROUP subcommand requires the key to exist')
+                stream = self._get_or_create(name, _Stream)
+            if groupname in stream.groups:
+                raise ResponseError('BUSYGROUP Consumer Group name already exists')
+            stream.groups[groupname] = _Group(stream.last_id if id == '$' else _parse_id(id))
+            return True
+
+    def _group(self, name, groupname):
+        stream = self._get(name, _Stream)
+        if stream is None or groupname not in stream.groups:
+            raise ResponseError(f"NOGROUP No such key '{name}' or consumer group '{groupname}'")
+        return stream, stream.groups[groupname]
+
+    def xreadgroup(self, groupname, consumername, streams, count=None, block=None, noack=False):
+        with self._lock:
+            response = []
+            for name, start in streams.items():
+                stream, group = self._group(name, groupname)
+                entries = []
+                if start == '>':
+                    for entry_id, fields in stream.entries.items():
+                        if entry_id <= group.last_id:
+                            continue
+                        entries.append((_format_id(entry_id), dict(fields)))
+                        group.last_id = entry_id
+                        if not noack:
+                            group.pending[entry_id] = [consumername, int(time.time() * 1000), 1]
+                        if count and len(entries) >= count:
+                            break
+                else:
+                    # 读取本消费者的挂起消息
+                    low = _parse_id(start)
+                    for entry_id, info in group.pending.items():
+                        if info[0] == consumername and entry_id > low:
+                            entries.append((_format_id(entry_id), dict(stream.entries.get(entry_id) or {}) or None))
+                            if count and len(entries) >= count:
+                                break
+                if entries:
+                    response.append([name, entries])
+            return response
+
+    def xack(self, name, groupname, *ids):
+        with self._lock:
+            _, group = self._group(name, groupname)
+            return sum(1 for i in ids if group.pending.pop(_parse_id(i), None) is not None)
+
+    def xpending(self, name, groupname):
+        with self._lock:
+            _, group = self._group(name, groupname)
+            ids = list(group.pending)
+            consumers = {}
+            for info in group.pending.values():
+                consumers[info[0]] = consumers.get(info[0], 0) + 1
+            return {
+                'pending': len(ids),
+                'min': _format_id(ids[0]) if ids else None,
+                'max': _format_id(ids[-1]) if ids else None,
+                'consumers': [{'name': c, 'pending': n} for c, n in consumers.items()],
+            }
+
+    def xautoclaim(self, name, groupname, consumername, min_idle_time, start_id='0-0', count=None, justid=False):
+        with self._lock:
+            stream, group = self._group(name, groupname)
+            now = int(time.time() * 1000)
+            start = _parse_id(start_id)
+            limit = count or 100
+            claimed, deleted = [], []
+            next_id = '0-0'
+            candidates = sorted(i for i in group.pending if i >= start)
+            for index, entry_id in enumerate(candidates):
+                if len(claimed) + len(deleted) >= limit:
+                    next_id = _format_id(entry_id)
+                    break
+                info = group.pending[entry_id]
+                if now - info[1] < min_idle_time:
+                    continue
+                if entry_id not in stream.entries:
+                    del group.pending[entry_id]
+                    deleted.append(_format_id(entry_id))
+                    continue
+                info[0], info[1], info[2] = consumername, now, info[2] + 1
+                claimed.append(_format_id(entry_id) if justid else (_format_id(entry_id), dict(stream.entries[entry_id])))
+            return [next_id, claimed, deleted]
+
+    # ---- 管道与脚本 ----
+
+    def pipeline(self, transaction=True):
+        return MemoryPipeline(self)
+
+    def register_script(self, script):
+        fn = SCRIPTS.get(script)
+        if fn is None:
+            raise ResponseError('ERR script has no in-memory equivalent registered')
+
+        def run(keys=None, args=None, client=None):
+            with self._lock:
+                return fn(self, list(keys or []), list(args or []))
+        return run
+
+
+class MemoryPipeline:
+    """缓存命令，execute() 时在存储锁内一次性执行"""
+
+    def __init__(self, store):
+        self._store = store
+        self._commands = []
+
+    def __getattr__(self, name):
+        method = getattr(self._store, name)
+
+        def queue(*args, **kwargs):
+            self._commands.append((method, args, kwargs))
+            return self
+        return queue
+
+    def __len__(self):
+        return len(self._commands)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._commands = []
+
+    def execute(self, raise_on_error=True):
+        results = []
+        with self._store._lock:
+            for method, args, kwargs in self._commands:
+                try:
+                    results.append(method(*args, **kwargs))
+                except ResponseError as e:
+                    results.append(e)
+        self._commands = []
+        if raise_on_error:
+            for result in results:
+                if isinstance(result, ResponseError):
+                    raise result
+        return results
+
+
+class AsyncMemoryRedis:
+    """MemoryRedis 的 asyncio 接口，与同步客户端共享数据；操作都在内存中完成，直接在事件循环中执行"""
+
+    def __init__(self, store):
+        self._store = store
+
+    def __getattr__(self, name):
+        method = getattr(self._store, name)
+
+        async def call(*args, **kwargs):
+            return method(*args, **kwargs)
+        return call
+
+    def pipeline(self, transaction=True):
+        return AsyncMemoryPipeline(self._store)
+
+    def register_script(self, script):
+        run = self._store.register_script(script)
+
+        async def call(keys=None, args=None, client=None):
+            return run(keys, args)
+        return call
+
+    async def aclose(self):
+        pass
+
+
+class AsyncMemoryPipeline(MemoryPipeline):
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self._commands = []
+
+    async def execute(self, raise_on_error=True):
+        return MemoryPipeline.execute(self, raise_on_error)
@@ -0,0 +1,277 @@
+"""
+消息队列后端
+
+通过环境变量 XIANYU_QUEUE_BACKEND 选择：
+- list（默认）：LPUSH 入队，RPOPLPUSH 取到处理队列，完成后 LREM
+- stream：Redis Streams 消费者组，XREADGROUP 取消息、XACK 确认，
+  超过可见性超时仍未确认的消息由 XAUTOCLAIM 转交给其他消费者，
+  支持多进程、多主机共同消费
+
+两种后端接口一致：push / push_to / fetch / ack / ack_to / nack，fetch 返回 [(handle, payload)]，
+ack / nack 使用 handle 确认或放回，*_to 版本把命令加入调用方的管道。
+所有方法都是阻塞调用，需通过 run_blocking 执行。
+
+消息按优先级分为 order（订单状态）、chat（聊天）、low（其他）三个通道，每个通道一个队列，
+LaneQueue 按权重轮流从各通道取消息，高优先级通道为空时依次取低优先级通道。
+"""
+import os
+import time
+import socket
+import threading
+import redis
+from loguru import logger
+import metrics
+
+# 消息通道，按优先级从高到低
+LANE_ORDER = 'order'
+LANE_CHAT = 'chat'
+LANE_LOW = 'low'
+LANES = (LANE_ORDER, LANE_CHAT, LANE_LOW)
+# 各通道都有积压时的取消息比例
+DEFAULT_LANE_WEIGHTS = {LANE_ORDER: 6, LANE_CHAT: 3, LANE_LOW: 1}
+
+
+def consumer_name(index):
+    """消费者名称：主机名:进程号:任务序号"""
+    return f"{socket.gethostname()}:{os.getpid()}:{index}"
+
+
+class RedisListQueue:
+    """基于列表的队列（原有实现）"""
+
+    def __init__(self, redis_client, queue_key, processing_key):
+        self.redis_client = redis_client
+        self.queue_key = queue_key
+        self.processing_key = processing_key
+
+    def push_to(self, pipe, payload):
+        """在 Redis 管道中入队"""
+        pipe.lpush(self.queue_key, payload)
+
+    def push(self, payload):
+        self.redis_client.lpush(self.queue_key, payload)
+
+    def fetch(self, consumer, count=1):
+        payload = self.redis_client.rpoplpush(self.queue_key, self.processing_key)
+        return [(payload, payload)] if payload else []
+
+    def ack(self, handle):
+        self.redis_client.lrem(self.processing_key, 0, handle)
+
+    def ack_to(self, pipe, handle):
+        """在 Redis 管道中确认消息"""
+        pipe.lrem(self.processing_key, 0, handle)
+
+    def depth(self):
+        """尚未确认的消息数（含已取出正在处理的）"""
+        pipe = self.redis_client.pipeline()
+        pipe.llen(self.queue_key)
+        pipe.llen(self.processing_key)
+        return sum(pipe.execute())
+
+    def nack(self, handle):
+        """处理失败：移回主队列"""
+        pipe = self.redis_client.pipeline()
+        pipe.lpush(self.queue_key, handle)
+        pipe.lrem(self.processing_key, 0, handle)
+        pipe.execute()
+
+
+class RedisStreamQueue:
+    """基于 Redis Streams 消费者组的队列"""
+
+    def __init__(self, redis_client, stream_key, group, visibility_timeout=60, maxlen=100000):
+        """
+        Args:
+            redis_client: Redis客户端（decode_responses=True）
+            stream_key: Stream 键名
+            group: 消费者组名
+            visibility_timeout: 消息被取走后多少秒未确认即可被其他消费者认领
+            maxlen: Stream 近似最大长度
+        """
+        self.redis_client = redis_client
+        self.stream_key = stream_key
+        self.group = group
+        self.visibility_timeout = visibility_timeout
+        self.maxlen = maxlen
+        self._claim_cursor = '0-0'
+        self._last_claim = 0.0
+        self.ensure_group()
+
+    def ensure_group(self):
+        try:
+            self.redis_client.xgroup_create(self.stream_key, self.group, id='0', mkstream=True)
+            logger.info(f"已创建消费者组 {self.group} ({self.stream_key})")
+        except redis.exceptions.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def push_to(self, pipe, payload):
+        """在 Redis 管道中入队"""
+        pipe.xadd(self.stream_key, {'payload': payload}, maxlen=self.maxlen, approximate=True)
+
+    def push(self, payload):
+        self.redis_client.xadd(self.stream_key, {'payload': payload}, maxlen=self.maxlen, approximate=True)
+
+    def _claim(self, consumer, count):
+        """认领超过可见性超时仍未确认的消息"""
+        next_id, entries, *_ = self.redis_client.xautoclaim(
+            self.stream_key, self.group, consumer,
+            min_idle_time=int(self.visibility_timeout * 1000),
+            start_id=self._claim_cursor,
+            count=count
+        )
+        self._claim_cursor = next_id
+        claimed = [(entry_id, fields['payload']) for entry_id, fields in entries if fields]
+        if claimed:
+            metrics.inc('queue.reclaimed', len(claimed))
+            logger.warning(f"{consumer} 认领了 {len(claimed)} 条超时未确认的消息")
+        return claimed
+
+    def fetch(self, consumer, count=1):
+        # 每半个可见性超时扫描一次挂起消息，即使持续有新消息也不会让卡住的消息饿死
+        now = time.monotonic()
+        if now - self._last_claim >= self.visibility_timeout / 2:
+            self._last_claim = now
+            claimed = self._claim(consumer, count)
+            if claimed:
+                return claimed
+        response = self.redis_client.xreadgroup(self.group, consumer, {self.stream_key: '>'}, count=count)
+        if not response:
+            return []
+        return [(entry_id, fields['payload']) for _, entries in response for entry_id, fields in entries]
+
+    def ack(self, handle):
+        pipe = self.redis_client.pipeline()
+        self.ack_to(pipe, handle)
+        pipe.execute()
+
+    def ack_to(self, pipe, handle):
+        """在 Redis 管道中确认消息"""
+        pipe.xack(self.stream_key, self.group, handle)
+        pipe.xdel(self.stream_key, handle)
+
+    def depth(self):
+        """尚未确认的消息数（确认时会删除条目，Stream 长度即积压）"""
+        return self.redis_client.xlen(self.stream_key)
+
+    def nack(self, handle):
+        """处理失败：重新追加到队尾，并确认原消息"""
+        entries = self.redis_client.xrange(self.stream_key, handle, handle)
+        pipe = self.redis_client.pipeline()
+        if entries:
+            self.push_to(pipe, entries[0][1]['payload'])
+        self.ack_to(pipe, handle)
+        pipe.execute()
+
+    def migrate_from_list(self, *list_keys, batch=500):
+        """把旧列表队列中的消息迁移到 Stream，按传入顺序逐个清空
+
+        列表由 LPUSH 写入，最旧的消息在右端；每批从右端读取后在同一事务中
+        XADD 并 LTRIM 掉这些元素，迁移期间仍有写入也不会丢失。
+
+        Returns:
+            int: 迁移的消息数
+        """
+        migrated = 0
+        for key in list_keys:
+            while True:
+                items = self.redis_client.lrange(key, -batch, -1)
+                if not items:
+                    break
+                pipe = self.redis_client.pipeline()
+                for payload in reversed(items):
+                    self.push_to(pipe, payload)
+                pipe.ltrim(key, 0, -(len(items) + 1))
+                pipe.execute()
+                migrated += len(items)
+        if migrated:
+            metrics.inc('queue.migrated', migrated)
+            logger.info(f"已将 {migrated} 条消息从列表队列迁移到 {self.stream_key}")
+        return migrated
+
+
+def create_queue(redis_client, backend='list', queue_key='xianyu:messages', processing_key='xianyu:processing',
+                 stream_key='xianyu:message_stream', group='xianyu:workers', visibility_timeout=60):
+    """按后端名称创建消息队列"""
+    if backend == 'stream':
+        return RedisStreamQueue(redis_client, stream_key, group, visibility_timeout=visibility_timeout)
+    if backend != 'list':
+        raise ValueError(f"未知的消息队列后端: {backend}")
+    return RedisListQueue(redis_client, queue_key, processing_key)
+
+
+class LaneQueue:
+    """按优先级通道组织的消息队列，handle 为 (通道, 通道内 handle)"""
+
+    def __init__(self, lanes, weights=None):
+        """
+        Args:
+            lanes: 通道名 -> 队列，按优先级从高到低排列
+            weights: 通道名 -> 权重
+        """
+        self.lanes = lanes
+        self.weights = weights or DEFAULT_LANE_WEIGHTS
+        self._current = {lane: 0 for lane in lanes}
+        self._lock = threading.Lock()
+
+    def _lane_order(self):
+        """平滑加权轮询选出本次优先尝试的通道，其余通道按优先级排在后面"""
+        with self._lock:
+            total = 0
+            best = None
+            for lane in self.lanes:
+                self._current[lane] += self.weights[lane]
+                total += self.weights[lane]
+                if best is None or self._current[lane] > self._current[best]:
+                    best = lane
+            self._current[best] -= total
+        return [best] + [lane for lane in self.lanes if lane != best]
+
+    def push_to(self, pipe, payload, lane=None):
+        self.lanes[lane or LANE_CHAT].push_to(pipe, payload)
+
+    def push(self, payload, lane=None):
+        self.lanes[lane or LANE_CHAT].push(payload)
+
+    def fetch(self, consumer, count=1):
+        for lane in self._lane_order():
+            items = self.lanes[lane].fetch(consumer, count)
+            if items:
+                return [((lane, handle), payload) for handle, payload in items]
+        return []
+
+    def ack(self, handle):
+        lane, handle = handle
+        self.lanes[lane].ack(handle)
+
+    def ack_to(self, pipe, handle):
+        lane, handle = handle
+        self.lanes[lane].ack_to(pipe, handle)
+
+    def nack(self, handle):
+        lane, handle = handle
+        self.lanes[lane].nack(handle)
+
+    def depths(self):
+        """各通道尚未确认的消息数"""
+        return {lane: queue.depth() for lane, queue in self.lanes.items()}
+
+
+def create_lane_queue(redis_client, backend='list', weights=None, queue_key='xianyu:messages',
+                      processing_key='xianyu:processing', stream_key='xianyu:message_stream',
+                      group='xianyu:workers', visibility_timeout=60):
+    """为每个通道创建一个队列，chat 通道沿用原有键名，其他通道在键名后加 :通道名"""
+    lanes = {}
+    for lane in LANES:
+        suffix = '' if lane == LANE_CHAT else f':{lane}'
+        lanes[lane] = create_queue(
+            redis_client,
+            backend=backend,
+            queue_key=queue_key + suffix,
+            processing_key=processing_key + suffix,
+            stream_key=stream_key + suffix,
+            group=group,
+            visibility_timeout=visibility_timeout
+        )
+    return LaneQueue(lanes, weights)
@@ -0,0 +1,75 @@
+"""
+订单事件流
+
+订单状态变化（等待买家付款、交易关闭、等待卖家发货）由读取任务发布到 Redis Stream
+xianyu:order_events，订单处理任务通过消费者组在事件到达后立即处理：
+- Stream 持久保存事件，未确认的事件超时后由其他消费者认领
+- 以 order_id + 状态 + 事件ID（订单消息自带的时间戳）做幂等：处理前 SET NX 标记处理中，
+  成功后标记完成；重复投递的事件只在标记为完成时确认跳过，标记仍为处理中时不确认，
+  留在挂起列表中等可见性超时后再次认领，原处理失败时事件不会丢失；失败时删除标记以便重试；
+  同一会话中再次下单或再次出现相同状态时事件ID不同，不会被当作重复事件
+"""
+import json
+from message_queue import RedisStreamQueue
+
+# 订单状态 -> 保存到订单消息表的描述
+ORDER_STATUS_MESSAGES = {
+    '等待买家付款': '订单创建，等待买家付款',
+    '交易关闭': '交易已关闭',
+    '等待卖家发货': '买家已付款，等待卖家发货',
+}
+
+
+class OrderEventStream:
+    """订单事件的发布、消费与幂等标记"""
+
+    def __init__(self, redis_client, stream_key='xianyu:order_events', group='xianyu:order_handlers',
+                 visibility_timeout=60, done_ttl=7 * 86400):
+        """
+        Args:
+            redis_client: Redis客户端（decode_responses=True）
+            stream_key: Stream 键名
+            group: 消费者组名
+            visibility_timeout: 事件取走后多少秒未确认可被其他消费者认领，也是处理中标记的有效期
+            done_ttl: 已完成标记的保留时间（秒）
+        """
+        self.redis_client = redis_client
+        self.queue = RedisStreamQueue(redis_client, stream_key, group, visibility_timeout=visibility_timeout)
+        self.visibility_timeout = visibility_timeout
+        self.done_ttl = done_ttl
+
+    def publish(self, order_id, status, user_url, received_at, event_id):
+        self.queue.push(json.dumps({
+            'order_id': order_id,
+            'status': status,
+            'event_id': event_id,
+            'user_url': user_url,
+            'received_at': received_at,
+        }, ensure_ascii=False))
+
+    def fetch(self, consumer, count=10):
+        """Returns: list of (handle, event)"""
+        return [(handle, json.loads(payload)) for handle, payload in self.queue.fetch(consumer, count)]
+
+    def ack(self, handle):
+        self.queue.ack(handle)
+
+    def nack(self, handle):
+        self.queue.nack(handle)
+
+    def _key(self, event):
+        return f"xianyu:order_event_done:{event['order_id']}:{event['status']}:{event.get('event_id', '')}"
+
+    def begin(self, event):
+        """标记开始处理，返回 False 表示已处理过或正在被处理"""
+        return bool(self.redis_client.set(self._key(event), 'processing', nx=True, ex=self.visibility_timeout))
+
+    def state(self, event):
+        """幂等标记的当前值：'processing'、'done'，没有标记时为 None"""
+        return self.redis_client.get(self._key(event))
+
+    def finish(self, event):
+        self.redis_client.set(self._key(event), 'done', ex=self.done_ttl)
+
+    def abort(self, event):
+        self.redis_client.delete(self._key(event))
@@ -0,0 +1,230 @@
+"""
+WebSocket 出站队列
+
+所有发往服务端的帧（注册、心跳、ACK、聊天回复）都进入同一个队列，由唯一的写任务
+按优先级发送：
+- 注册帧（/reg、ackDiff）优先级最高；新连接注册期间只发送注册帧，注册完成后才发送其他帧
+- 心跳、ACK 优先于聊天回复，且不受队列深度限制
+- 聊天回复按账号限速（令牌桶），等待令牌时不占用写任务，期间到达的控制帧先发送；
+  队列满时 put() 等待，形成背压
+- 连接断开时暂停发送，聊天回复保留到重连后在新连接上发出；
+  注册帧、心跳和 ACK 只对原连接有意义，断开时丢弃
+"""
+import time
+import heapq
+import asyncio
+import itertools
+from loguru import logger
+import metrics
+
+PRIORITY_REGISTER = 0
+PRIORITY_HEARTBEAT = 1
+PRIORITY_ACK = 2
+PRIORITY_CHAT = 3
+
+_PRIORITY_NAMES = {
+    PRIORITY_REGISTER: 'register',
+    PRIORITY_HEARTBEAT: 'heartbeat',
+    PRIORITY_ACK: 'ack',
+    PRIORITY_CHAT: 'chat',
+}
+
+
+class TokenBucket:
+    """令牌桶限速"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def try_acquire(self):
+        """尝试取一个令牌：成功返回 0，否则返回还需等待的秒数"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class OutboundQueue:
+    """单写者出站队列"""
+
+    def __init__(self, max_depth=1000, rate=2.0, burst=5, name='outbound'):
+        """
+        Args:
+            max_depth: 聊天回复的最大排队数，超过后 put() 等待
+            rate: 每秒允许发送的聊天回复数
+            burst: 限速令牌桶容量
+            name: 指标名前缀
+        """
+        self.max_depth = max_depth
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self._heap = []
+        self._seq = itertools.count()
+        self._chat_depth = 0
+        self._ws = None
+        self._registering = False
+        self._cond = None
+
+    def _condition(self):
+        # 在事件循环中创建，兼容旧版本 asyncio 对 loop 绑定的要求
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    def _update_depth(self):
+        metrics.set_gauge(f'{self.name}.depth', len(self._heap))
+        metrics.set_gauge(f'{self.name}.chat_depth', self._chat_depth)
+
+    @property
+    def depth(self):
+        return len(self._heap)
+
+    def _push(self, priority, payload, enqueued_at=None, seq=None, on_sent=None):
+        heapq.heappush(self._heap, (priority, next(self._seq) if seq is None else seq, payload,
+                                    enqueued_at or time.monotonic(), on_sent))
+        if priority == PRIORITY_CHAT:
+            self._chat_depth += 1
+        self._update_depth()
+
+    async def put(self, payload, priority=PRIORITY_CHAT, on_sent=None):
+        """入队一条待发送的帧，聊天回复在队列满时等待
+
+        on_sent: 可选回调，ws.send 返回后由写任务调用，用于记录实际发出的时间
+        """
+        cond = self._condition()
+        async with cond:
+            if priority == PRIORITY_CHAT and self._chat_depth >= self.max_depth:
+                metrics.inc(f'{self.name}.backpressure')
+                started = time.monotonic()
+                await cond.wait_for(lambda: self._chat_depth < self.max_depth)
+                metrics.observe(f'{self.name}.backpressure_wait', time.monotonic() - started)
+            self._push(priority, payload, on_sent=on_sent)
+            cond.notify_all()
+
+    def attach(self, ws, registering=False):
+        """绑定新连接；registering 为 True 时只发送注册帧，注册完成后再次调用 attach(ws) 开始发送积压的消息"""
+        self._ws = ws
+        self._registering = registering
+        self._notify()
+        if not registering:
+            logger.info(f"出站队列已绑定新连接，积压 {self._chat_depth} 条聊天消息")
+
+    def detach(self):
+        """连接断开：暂停发送，丢弃只对旧连接有效的注册帧、心跳和ACK"""
+        self._ws = None
+        self._registering = False
+        before = len(self._heap)
+        self._heap = [item for item in self._heap if item[0] == PRIORITY_CHAT]
+        heapq.heapify(self._heap)
+        dropped = before - len(self._heap)
+        if dropped:
+            metrics.inc(f'{self.name}.dropped_control', dropped)
+        self._update_depth()
+
+    def _notify(self):
+        cond = self._condition()
+
+        async def notify():
+            async with cond:
+                cond.notify_all()
+        asyncio.ensure_future(notify())
+
+    def _sendable(self):
+        if self._ws is None or not self._heap:
+            return False
+        # 注册期间只发送注册帧（优先级最高，有注册帧时必在堆顶）
+        return not self._registering or self._heap[0][0] == PRIORITY_REGISTER
+
+    async def _next(self):
+        """等待有可用连接且队列非空，取出优先级最高的帧
+
+        堆顶是聊天回复时只在有令牌时取出；等待令牌期间到达的注册帧、心跳和ACK排在它前面，先被取出发送
+        """
+        cond = self._condition()
+        async with cond:
+            throttled_at = None
+            while True:
+                await cond.wait_for(self._sendable)
+                if self._heap[0][0] != PRIORITY_CHAT:
+                    break
+                delay = self.bucket.try_acquire()
+                if not delay:
+                    if throttled_at is not None:
+                        metrics.observe(f'{self.name}.rate_limit_wait', time.monotonic() - throttled_at)
+                    break
+                if throttled_at is None:
+                    throttled_at = time.monotonic()
+                try:
+                    await asyncio.wait_for(cond.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+            item = heapq.heappop(self._heap)
+            if item[0] == PRIORITY_CHAT:
+                self._chat_depth -= 1
+            self._update_depth()
+            cond.notify_all()
+            return self._ws, item
+
+    async def _requeue(self, item):
+        cond = self._condition()
+        async with cond:
+            # 保留原序号，重连后仍按原顺序发送
+            self._push(item[0], item[2], enqueued_at=item[3], seq=item[1], on_sent=item[4])
+            cond.notify_all()
+
+    async def run(self):
+        """唯一的写任务"""
+        while True:
+            ws, item = await self._next()
+            priority, _, payload, enqueued_at, on_sent = item
+            try:
+                await ws.send(payload)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"出站消息发送失败，等待重连后重发: {e}")
+                if ws is self._ws:
+                    self.detach()
+                if priority == PRIORITY_CHAT:
+                    await self._requeue(item)
+                continue
+            if on_sent is not None:
+                on_sent()
+            kind = _PRIORITY_NAMES.get(priority, str(priority))
+            metrics.inc(f'{self.name}.sent.{kind}')
+            metrics.observe(f'{self.name}.queue_time.{kind}', time.monotonic() - enqueued_at)
+
+
+if __name__ == '__main__':
+    # 自检：限速中的聊天回复不应阻塞随后入队的心跳
+    class _RecordingWS:
+        def __init__(self):
+            self.sent = []
+
+        async def send(self, payload):
+            self.sent.append((payload, time.monotonic()))
+
+    async def _check():
+        ws = _RecordingWS()
+        queue = OutboundQueue(rate=0.2, burst=1)
+        queue.attach(ws)
+        writer = asyncio.ensure_future(queue.run())
+        started = time.monotonic()
+        await queue.put('chat-1')
+        await queue.put('chat-2')
+        await asyncio.sleep(0.1)
+        await queue.put('heartbeat', PRIORITY_HEARTBEAT)
+        await asyncio.sleep(0.2)
+        writer.cancel()
+        assert [payload for payload, _ in ws.sent] == ['chat-1', 'heartbeat'], ws.sent
+        assert ws.sent[1][1] - started < 0.5, ws.sent
+        assert queue.depth == 1
+
+    asyncio.run(_check())
+    print('outbound 自检通过')
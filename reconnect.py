@@ -0,0 +1,56 @@
+"""
+断线重连
+
+连接断开或注册失败时不再重启进程，而是在同一进程内按带抖动的指数退避重连：
+- 每次重连都会重新获取 accessToken 并重新注册，任务、线程池、出站队列保持不变
+- accessToken 连续获取失败达到阈值后，才在进程内刷新一次 Cookie
+"""
+import random
+from loguru import logger
+import metrics
+from utils.xianyu_utils import trans_cookies
+
+
+class TokenError(RuntimeError):
+    """获取 accessToken 失败，通常意味着 Cookie 已失效"""
+
+
+class Backoff:
+    """带抖动的指数退避（full jitter）"""
+
+    def __init__(self, base=1.0, maximum=60.0, factor=2.0):
+        self.base = base
+        self.maximum = maximum
+        self.factor = factor
+        self.attempts = 0
+
+    def next(self):
+        """返回下一次重连前的等待秒数"""
+        ceiling = min(self.maximum, self.base * (self.factor ** self.attempts))
+        self.attempts += 1
+        # 在 [base/2, ceiling] 内随机，避免多个实例同时重连
+        return random.uniform(min(self.base / 2, ceiling), ceiling)
+
+    def reset(self):
+        self.attempts = 0
+
+
+async def refresh_session(self):
+    """在进程内刷新 Cookie，成功返回 True"""
+    metrics.inc('reconnect.cookie_refresh')
+    try:
+        cookies_str = await self.run_blocking(self.cookie_refresher)
+    except Exception as e:
+        logger.error(f"刷新Cookie失败: {e}")
+        return False
+    if not cookies_str:
+        logger.error("刷新Cookie失败: 未获取到Cookie")
+        return False
+    cookies = trans_cookies(cookies_str)
+    if cookies.get('unb') != self.myid:
+        logger.error(f"刷新后的Cookie属于其他账号({cookies.get('unb')})，忽略")
+        return False
+    self.cookies_str = cookies_str
+    self.cookies = cookies
+    logger.info("Cookie已在进程内刷新")
+    return True
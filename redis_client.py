@@ -0,0 +1,63 @@
+"""
+Redis 连接
+
+同步客户端（线程池中的阻塞调用）与 asyncio 客户端（事件循环中的热路径）使用同一组配置，
+各自共享一个有界连接池：
+- REDIS_HOST / REDIS_PORT / REDIS_DB / REDIS_PASSWORD
+- REDIS_SOCKET_TIMEOUT / REDIS_CONNECT_TIMEOUT：读写与建连超时（秒）
+- REDIS_MAX_CONNECTIONS：每个连接池的最大连接数，连接用尽时等待而不是报错
+
+XIANYU_STORE_BACKEND=memory 时不连接 Redis，两个客户端共用同一个进程内存储（memory_store），
+适用于单进程部署和无 Redis 环境下的测试。
+"""
+import os
+import redis
+import redis.asyncio
+from memory_store import MemoryRedis, AsyncMemoryRedis
+
+_memory_store = None
+
+
+def redis_options():
+    """从环境变量读取连接参数"""
+    return {
+        'host': os.getenv('REDIS_HOST', 'localhost'),
+        'port': int(os.getenv('REDIS_PORT', '6379')),
+        'db': int(os.getenv('REDIS_DB', '0')),
+        'password': os.getenv('REDIS_PASSWORD') or None,
+        'socket_timeout': float(os.getenv('REDIS_SOCKET_TIMEOUT', '5')),
+        'socket_connect_timeout': float(os.getenv('REDIS_CONNECT_TIMEOUT', '5')),
+        'health_check_interval': 30,
+        'decode_responses': True,
+    }
+
+
+def max_connections():
+    return int(os.getenv('REDIS_MAX_CONNECTIONS', '32'))
+
+
+def store_backend():
+    return os.getenv('XIANYU_STORE_BACKEND', 'redis')
+
+
+def _get_memory_store():
+    global _memory_store
+    if _memory_store is None:
+        _memory_store = MemoryRedis()
+    return _memory_store
+
+
+def create_redis():
+    """创建使用共享连接池的同步客户端"""
+    if store_backend() == 'memory':
+        return _get_memory_store()
+    pool = redis.BlockingConnectionPool(max_connections=max_connections(), timeout=10, **redis_options())
+    return redis.Redis(connection_pool=pool)
+
+
+def create_async_redis():
+    """创建使用共享连接池的 asyncio 客户端，只能在同一个事件循环中使用"""
+    if store_backend() == 'memory':
+        return AsyncMemoryRedis(_get_memory_store())
+    pool = redis.asyncio.BlockingConnectionPool(max_connections=max_connections(), timeout=10, **redis_options())
+    return redis.asyncio.Redis(connection_pool=pool)
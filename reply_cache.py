@@ -0,0 +1,192 @@
+"""
+回复缓存
+
+买家针对同一商品反复询问的常见问题（还在吗、包邮吗……）直接复用之前的回复：
+- 键为 (商品或会话, 意图, 归一化后的问题)，议价类问题（命中任一价格规则的消息）依赖议价轮次，不缓存
+- 缓存的回复会发给其他买家，调用方只缓存不带买家上下文（历史消息、会话、昵称）生成的回复
+- 进程内 LRU 缓存，超过容量淘汰最久未使用的条目，条目超过 TTL 失效
+- 可选 Redis 二级缓存，多个进程共享
+- 同一个键同时只调用一次大模型，并发的相同问题共享结果（single-flight）
+- 命中率等指标：reply_cache.hit / reply_cache.miss / reply_cache.shared，仪表 reply_cache.hit_rate
+"""
+import re
+import time
+import asyncio
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+import metrics
+
+_NON_WORD = re.compile(r'[^\w\u4e00-\u9fa5]')
+
+
+def normalize_question(text):
+    """全角转半角、统一大小写并去掉标点和空白，"包邮吗？？" 与 "包邮吗" 视为同一问题"""
+    return _NON_WORD.sub('', unicodedata.normalize('NFKC', text)).lower()
+
+
+class Uncached:
+    """factory 返回 Uncached(回复) 时照常返回回复，但不写入缓存（例如生成后才知道是议价回复）"""
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+
+class ReplyCache:
+    """带 TTL 与 LRU 淘汰的回复缓存，支持同步与异步调用"""
+
+    def __init__(self, capacity=1000, ttl=3600, redis_client=None, aredis=None,
+                 key_prefix='xianyu:reply_cache', cacheable=None):
+        """
+        Args:
+            capacity: 进程内缓存的最大条目数
+            ttl: 缓存有效期（秒）
+            redis_client: 同步 Redis 客户端，设置后启用二级缓存（get_or_create 使用）
+            aredis: asyncio Redis 客户端，设置后启用二级缓存（aget_or_create 使用）
+            key_prefix: Redis 键名前缀
+            cacheable: 判断回复是否可以缓存的函数，默认缓存所有非空回复
+        """
+        self.capacity = capacity
+        self.ttl = ttl
+        self.redis_client = redis_client
+        self.aredis = aredis
+        self.key_prefix = key_prefix
+        self.cacheable = cacheable or bool
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._inflight = {}       # 异步：键 -> [共享任务, 等待数]
+        self._sync_inflight = {}  # 同步：键 -> threading.Event
+        self._hits = 0
+        self._lookups = 0
+
+    def key(self, scope, intent, question):
+        """缓存键；未启用缓存（ttl<=0）或问题归一化后为空时返回 None（不缓存）"""
+        normalized = normalize_question(question)
+        if not normalized or self.ttl <= 0:
+            return None
+        return f"{scope}|{intent}|{normalized}"
+
+    def _redis_key(self, key):
+        return f"{self.key_prefix}:{hashlib.sha1(key.encode()).hexdigest()}"
+
+    def _record(self, result):
+        metrics.inc(f'reply_cache.{result}')
+        with self._lock:
+            self._lookups += 1
+            if result != 'miss':
+                self._hits += 1
+            metrics.set_gauge('reply_cache.hit_rate', round(self._hits / self._lookups, 4))
+
+    def _get_local(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def _put_local(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def get_or_create(self, key, factory):
+        """同步版本：命中缓存直接返回，否则调用 factory()；key 为 None 时不经过缓存"""
+        if key is None:
+            value = factory()
+            return value.value if isinstance(value, Uncached) else value
+        value = self._get_local(key)
+        if value is None and self.redis_client is not None:
+            value = self.redis_client.get(self._redis_key(key))
+            if value is not None:
+                self._put_local(key, value)
+        if value is not None:
+            self._record('hit')
+            return value
+
+        with self._lock:
+            event = self._sync_inflight.get(key)
+            leader = event is None
+            if leader:
+                event = self._sync_inflight[key] = threading.Event()
+        if not leader:
+            # 等待正在进行的相同调用；超时或对方失败时自行调用
+            event.wait(timeout=60)
+            value = self._get_local(key)
+            if value is not None:
+                self._record('shared')
+                return value
+
+        self._record('miss')
+        try:
+            value = factory()
+            if isinstance(value, Uncached):
+                return value.value
+            self._store(key, value)
+            return value
+        finally:
+            if leader:
+                with self._lock:
+                    self._sync_inflight.pop(key, None)
+                event.set()
+
+    def _store(self, key, value):
+        if not self.cacheable(value):
+            return
+        self._put_local(key, value)
+        if self.redis_client is not None:
+            self.redis_client.set(self._redis_key(key), value, ex=self.ttl)
+
+    async def aget_or_create(self, key, factory):
+        """异步版本：factory 为返回协程的函数；key 为 None 时不经过缓存
+
+        并发的相同问题共享同一次调用；某个等待方被取消不影响其他等待方，
+        所有等待方都取消后才取消这次调用
+        """
+        if key is None:
+            value = await factory()
+            return value.value if isinstance(value, Uncached) else value
+        value = self._get_local(key)
+        if value is None and self.aredis is not None:
+            value = await self.aredis.get(self._redis_key(key))
+            if value is not None:
+                self._put_local(key, value)
+        if value is not None:
+            self._record('hit')
+            return value
+
+        entry = self._inflight.get(key)
+        if entry is None:
+            self._record('miss')
+            entry = self._inflight[key] = [asyncio.ensure_future(self._afill(key, factory)), 0]
+        else:
+            self._record('shared')
+        task = entry[0]
+        entry[1] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and not task.done():
+                task.cancel()
+
+    async def _afill(self, key, factory):
+        try:
+            value = await factory()
+            if isinstance(value, Uncached):
+                return value.value
+            if self.cacheable(value):
+                self._put_local(key, value)
+                if self.aredis is not None:
+                    await self.aredis.set(self._redis_key(key), value, ex=self.ttl)
+            return value
+        finally:
+            self._inflight.pop(key, None)
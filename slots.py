@@ -0,0 +1,79 @@
+"""
+会话处理槽
+
+按会话键一致性哈希到固定数量的处理槽，每个槽是一个任务加一个有界邮箱：
+- 聊天消息按会话ID（message['1']['2']）分槽：同一会话的消息入库和回复的保存、发送严格按提交顺序执行；
+  回复生成（大模型调用）在槽外进行，只有保存和发送回到槽中，慢的生成不阻塞同槽的其他会话
+- 订单事件按订单消息中的ID（message['1']，即订单事件的 order_id）分槽，与聊天消息只在两者ID相同时同槽，
+  订单事件的处理不依赖与聊天消息的先后顺序
+- 不同会话分散在各个槽中并行执行
+- 邮箱满时提交方等待，形成背压；每个槽的积压数量导出为 slots.backlog.{序号}
+"""
+import zlib
+import asyncio
+from loguru import logger
+import metrics
+
+
+def slot_index(key, size):
+    """稳定哈希，不同进程、不同启动之间结果一致"""
+    return zlib.crc32(str(key).encode()) % size
+
+
+class ConversationSlots:
+    """按会话分区的顺序执行槽"""
+
+    def __init__(self, size=10, capacity=100):
+        """
+        Args:
+            size: 槽数量，即不同会话的最大并行度
+            capacity: 每个槽邮箱的容量
+        """
+        self.size = size
+        self.capacity = capacity
+        self.queues = []
+        self.tasks = []
+
+    def start(self):
+        """在当前事件循环中启动所有槽"""
+        self.queues = [asyncio.Queue(maxsize=self.capacity) for _ in range(self.size)]
+        self.tasks = [asyncio.create_task(self._run(i), name=f'Slot-{i}') for i in range(self.size)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks.clear()
+
+    async def submit(self, key, func, *args):
+        """把 func(*args) 提交到 key 对应的槽，返回其结果的 Future"""
+        index = slot_index(key, self.size)
+        queue = self.queues[index]
+        future = asyncio.get_running_loop().create_future()
+        await queue.put((func, args, future))
+        metrics.set_gauge(f'slots.backlog.{index}', queue.qsize())
+        return future
+
+    def backlog(self):
+        return [queue.qsize() for queue in self.queues]
+
+    async def _run(self, index):
+        queue = self.queues[index]
+        while True:
+            func, args, future = await queue.get()
+            metrics.set_gauge(f'slots.backlog.{index}', queue.qsize())
+            if future.cancelled():
+                continue
+            try:
+                result = await func(*args)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                logger.debug(f"处理槽 {index} 的任务失败: {e}")
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                # 提交方可能已取消等待
+                if not future.done():
+                    future.set_result(result)
@@ -0,0 +1,58 @@
+// 常驻 Node 进程：加载一次签名脚本，按行读取 JSON 请求并逐行返回结果
+// 请求: {"id": 1, "fn": "generate_sign", "args": [...]}
+// 响应: {"id": 1, "result": ...} 或 {"id": 1, "error": "..."}
+// 批量请求: {"id": 2, "fn": "decrypt", "batch": [[...], [...]]}
+// 批量响应: {"id": 2, "results": [{"result": ...}, {"error": "..."}]}，顺序与请求一致
+const fs = require('fs')
+const vm = require('vm')
+const readline = require('readline')
+
+const scriptPath = process.argv[2]
+const noop = () => {}
+// 脚本加载时会打印示例输出，stdout 专用于协议，这里屏蔽脚本内的 console
+const sandbox = {
+    require, Buffer, TextDecoder, TextEncoder, atob, btoa,
+    console: {log: noop, info: noop, debug: noop, warn: noop, error: noop},
+}
+vm.createContext(sandbox)
+vm.runInContext(fs.readFileSync(scriptPath, 'utf-8'), sandbox, {filename: scriptPath})
+
+const functions = {}
+const lookup = (name) => {
+    if (!/^[A-Za-z_$][\w$]*$/.test(name)) {
+        throw new Error(`invalid function name ${name}`)
+    }
+    if (!(name in functions)) {
+        const fn = vm.runInContext(`typeof ${name} === 'function' ? ${name} : undefined`, sandbox)
+        if (!fn) {
+            throw new Error(`function ${name} is not defined in ${scriptPath}`)
+        }
+        functions[name] = fn
+    }
+    return functions[name]
+}
+
+const rl = readline.createInterface({input: process.stdin, terminal: false})
+rl.on('line', (line) => {
+    let request
+    try {
+        request = JSON.parse(line)
+        const fn = lookup(request.fn)
+        if (request.batch) {
+            const results = request.batch.map((args) => {
+                try {
+                    return {result: fn(...args)}
+                } catch (e) {
+                    return {error: String(e)}
+                }
+            })
+            process.stdout.write(JSON.stringify({id: request.id, results: results}) + '\n')
+            return
+        }
+        const result = fn(...(request.args || []))
+        process.stdout.write(JSON.stringify({id: request.id, result: result}) + '\n')
+    } catch (e) {
+        process.stdout.write(JSON.stringify({id: request ? request.id : null, error: String(e)}) + '\n')
+    }
+})
+rl.on('close', () => process.exit(0))
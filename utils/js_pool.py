@@ -0,0 +1,204 @@
+"""
+常驻 Node 进程池
+
+每个进程只加载一次签名脚本（static/js_worker.js 负责加载），之后通过
+stdin/stdout 按行收发 JSON 请求，避免 execjs 每次调用都启动 Node 并重新编译脚本。
+每个进程由一个读线程读取 stdout，请求超过读取期限没有响应时杀掉并重启进程。
+"""
+import os
+import json
+import time
+import queue
+import atexit
+import itertools
+import threading
+import subprocess
+from loguru import logger
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'static')
+WORKER_SCRIPT = os.path.join(STATIC_DIR, 'js_worker.js')
+
+
+class JSCallError(RuntimeError):
+    """JS 函数执行抛出异常"""
+
+
+class JSWorkerCrashed(RuntimeError):
+    """Node 进程意外退出或管道断开"""
+
+
+class JSWorkerTimeout(JSWorkerCrashed):
+    """Node 进程在读取期限内没有响应"""
+
+
+class _NodeWorker:
+    """单个 Node 进程，同一时刻只被一个线程使用"""
+
+    def __init__(self, script_path, node_path='node', timeout=10.0):
+        self.script_path = script_path
+        self.node_path = node_path
+        self.timeout = timeout
+        self.proc = None
+        self._lines = None
+        self._ids = itertools.count(1)
+        self.start()
+
+    def start(self):
+        self.proc = subprocess.Popen(
+            [self.node_path, WORKER_SCRIPT, self.script_path],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            encoding='utf-8',
+            bufsize=1,
+        )
+        # 每个进程一个读线程和一个行队列，重启后旧进程残留的输出不会被读到
+        self._lines = queue.Queue()
+        threading.Thread(target=self._read_stdout, args=(self.proc.stdout, self._lines),
+                         name='JSWorkerReader', daemon=True).start()
+
+    @staticmethod
+    def _read_stdout(stdout, lines):
+        try:
+            for line in stdout:
+                lines.put(line)
+        except (OSError, ValueError):
+            pass
+        lines.put('')  # 进程退出或管道关闭
+
+    def restart(self, attempts=3, backoff=0.5):
+        """关闭并重新启动进程，启动失败时重试，全部失败则抛出异常（proc 保持为 None，下次请求时再启动）"""
+        self.close()
+        for attempt in range(1, attempts + 1):
+            try:
+                self.start()
+                return
+            except OSError as e:
+                self.proc = None
+                if attempt == attempts:
+                    raise JSWorkerCrashed(f"Node 进程启动失败: {e}")
+                logger.warning(f"Node 进程启动失败，{backoff * attempt:.1f} 秒后重试: {e}")
+                time.sleep(backoff * attempt)
+
+    def close(self):
+        if self.proc and self.proc.poll() is None:
+            try:
+                self.proc.stdin.close()
+                self.proc.wait(timeout=2)
+            except Exception:
+                self.proc.kill()
+        self.proc = None
+
+    def kill(self):
+        if self.proc:
+            try:
+                self.proc.kill()
+                self.proc.wait(timeout=2)
+            except Exception:
+                pass
+        self.proc = None
+
+    def call(self, fn, args):
+        return self._request({'fn': fn, 'args': list(args)})['result']
+
+    def call_batch(self, fn, batch):
+        return self._request({'fn': fn, 'batch': [list(args) for args in batch]})['results']
+
+    def _request(self, request):
+        if self.proc is None:
+            # 上次重启失败，使用前重新启动
+            self.restart()
+        request_id = next(self._ids)
+        request['id'] = request_id
+        try:
+            self.proc.stdin.write(json.dumps(request) + '\n')
+            self.proc.stdin.flush()
+        except (BrokenPipeError, OSError, ValueError) as e:
+            raise JSWorkerCrashed(str(e))
+        try:
+            line = self._lines.get(timeout=self.timeout)
+        except queue.Empty:
+            # 进程卡住：杀掉进程，由调用方重启
+            self.kill()
+            raise JSWorkerTimeout(f"Node 进程 {self.timeout:.0f} 秒内没有响应")
+        if not line:
+            raise JSWorkerCrashed(f"Node 进程已退出，返回码: {self.proc.poll()}")
+        response = json.loads(line)
+        if response.get('id') != request_id:
+            raise JSWorkerCrashed(f"响应ID不匹配: {response.get('id')} != {request_id}")
+        if 'error' in response:
+            raise JSCallError(response['error'])
+        return response
+
+
+class JSEnginePool:
+    """Node 进程池，支持多线程并发调用与进程崩溃自动重启"""
+
+    def __init__(self, script_path, size=4, node_path='node', timeout=10.0):
+        """
+        Args:
+            script_path: 签名脚本路径
+            size: Node 进程数
+            node_path: node 可执行文件
+            timeout: 单次请求的读取期限（秒），超时杀掉并重启进程
+        """
+        self.script_path = script_path
+        self.size = size
+        self.node_path = node_path
+        self.timeout = timeout
+        self._idle = queue.Queue()
+        self._workers = []
+        self._lock = threading.Lock()
+        self._started = False
+
+    def _ensure_started(self):
+        if self._started:
+            return
+        with self._lock:
+            if self._started:
+                return
+            for _ in range(self.size):
+                worker = _NodeWorker(self.script_path, self.node_path, self.timeout)
+                self._workers.append(worker)
+                self._idle.put(worker)
+            self._started = True
+            atexit.register(self.close)
+            logger.info(f"JS进程池已启动: {self.size} 个进程, 脚本 {os.path.basename(self.script_path)}")
+
+    def _run(self, method, *args):
+        """在空闲进程上执行请求，进程崩溃时重启并重试一次；超时时重启但不重试，避免同一请求再次卡住
+
+        重启失败时进程保持未启动状态放回空闲队列，下次使用前重新启动
+        """
+        self._ensure_started()
+        worker = self._idle.get()
+        try:
+            try:
+                return getattr(worker, method)(*args)
+            except JSWorkerCrashed as e:
+                logger.warning(f"JS进程异常，正在重启: {e}")
+                worker.restart()
+                if isinstance(e, JSWorkerTimeout):
+                    raise
+                return getattr(worker, method)(*args)
+        finally:
+            self._idle.put(worker)
+
+    def call(self, fn, *args):
+        """调用脚本中的函数"""
+        return self._run('call', fn, args)
+
+    def call_batch(self, fn, batch):
+        """一次请求内对多组参数调用同一函数
+
+        Returns:
+            list: 与 batch 顺序一致，每项为 {"result": ...} 或 {"error": "..."}
+        """
+        return self._run('call_batch', fn, batch)
+
+    def close(self):
+        with self._lock:
+            for worker in self._workers:
+                worker.close()
+            self._workers.clear()
+            self._idle = queue.Queue()
+            self._started = False
@@ -0,0 +1,337 @@
+"""
+纯Python实现的 MessagePack 解码器
+
+与 static/xianyu_js_version_2.js 中的 decrypt() 行为保持一致：
+- 输入为 base64 字符串（会先去掉非 base64 字符）
+- 64位整数（uint64/int64）输出为字符串
+- map 的键统一转为字符串（如 1 -> "1"），并按 JS 对象的键顺序输出
+- 数据不完整时抛出 "Unexpected end of MessagePack data"
+"""
+import base64
+import json
+import math
+import re
+import struct
+from decimal import Decimal
+
+_NON_BASE64 = re.compile(r'[^A-Za-z0-9+/]')
+_MAX_INDEX = 2 ** 32 - 2
+_SMALL_INT_KEYS = [str(i) for i in range(0x80)]
+
+_unpack_u16 = struct.Struct('>H').unpack_from
+_unpack_u32 = struct.Struct('>I').unpack_from
+_unpack_u64 = struct.Struct('>Q').unpack_from
+_unpack_i8 = struct.Struct('>b').unpack_from
+_unpack_i16 = struct.Struct('>h').unpack_from
+_unpack_i32 = struct.Struct('>i').unpack_from
+_unpack_i64 = struct.Struct('>q').unpack_from
+_unpack_f32 = struct.Struct('>f').unpack_from
+_unpack_f64 = struct.Struct('>d').unpack_from
+
+_UNEXPECTED_END = "Unexpected end of MessagePack data"
+# JS 中定长数值通过 DataView 读取，越界时报该错误
+_OUT_OF_BOUNDS = "Offset is outside the bounds of the DataView"
+
+
+class MessagePackDecodeError(ValueError):
+    """MessagePack 数据无法解码"""
+
+
+def _is_index_key(key):
+    """是否为 JS 数组下标形式的键（"0"、"1"、"10"，无前导零）"""
+    return (key.isascii() and key.isdigit()
+            and (key[0] != '0' or len(key) == 1) and int(key) <= _MAX_INDEX)
+
+
+def _js_number(value):
+    """把浮点数规整成 JSON.stringify 的输出形式"""
+    if math.isnan(value) or math.isinf(value):
+        return None
+    if value == int(value) and abs(value) < 1e21:
+        return int(value)
+    return value
+
+
+def _js_float_str(value):
+    """按 JS Number#toString 规则格式化浮点数（Python repr 的指数格式与 JS 不同）"""
+    sign, digits, exponent = Decimal(repr(value)).as_tuple()
+    # exponent 换算为小数点位置：value = 0.digits * 10^exponent
+    exponent += len(digits)
+    digits = ''.join(map(str, digits)).rstrip('0') or '0'
+    k = len(digits)
+    prefix = '-' if sign else ''
+    if k <= exponent <= 21:
+        return prefix + digits + '0' * (exponent - k)
+    if 0 < exponent <= 21:
+        return prefix + digits[:exponent] + '.' + digits[exponent:]
+    if -6 < exponent <= 0:
+        return prefix + '0.' + '0' * (-exponent) + digits
+    e = exponent - 1
+    mantissa = digits[0] + ('.' + digits[1:] if k > 1 else '')
+    return f"{prefix}{mantissa}e{'+' if e > 0 else '-'}{abs(e)}"
+
+
+def _dumps_js(value):
+    """含非整数浮点数时使用的 JSON 序列化，数值格式与 JSON.stringify 一致"""
+    if isinstance(value, float):
+        return _js_float_str(value)
+    if isinstance(value, dict):
+        return '{' + ','.join(json.dumps(k, ensure_ascii=False) + ':' + _dumps_js(v) for k, v in value.items()) + '}'
+    if isinstance(value, list):
+        return '[' + ','.join(_dumps_js(v) for v in value) + ']'
+    return json.dumps(value, ensure_ascii=False)
+
+
+def _js_key(value):
+    """与 JS 中 sy() 一致：把非字符串的键转为字符串"""
+    if isinstance(value, str):
+        return value
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if value is None:
+        return 'null'
+    if isinstance(value, (int, float)):
+        if isinstance(value, float):
+            value = _js_number(value)
+            if value is None:
+                return 'null'
+            if isinstance(value, float):
+                return _js_float_str(value)
+        return str(value)
+    raise MessagePackDecodeError("Invalid property type for record")
+
+
+def _lenient_utf8(buf, pos, length):
+    """移植自 JS so()：对非法 UTF-8 的容错解码，返回 (字符串, 新位置)"""
+    end = pos + length
+    size = len(buf)
+
+    def byte_at(i):
+        return buf[i] if i < size else 0
+
+    units = []
+    while pos < end:
+        b = byte_at(pos)
+        pos += 1
+        if b & 0x80 == 0:
+            units.append(b)
+        elif b & 0xE0 == 0xC0:
+            units.append((b & 31) << 6 | (byte_at(pos) & 63))
+            pos += 1
+        elif b & 0xF0 == 0xE0:
+            units.append((b & 31) << 12 | (byte_at(pos) & 63) << 6 | (byte_at(pos + 1) & 63))
+            pos += 2
+        elif b & 0xF8 == 0xF0:
+            cp = (b & 7) << 18 | (byte_at(pos) & 63) << 12 | (byte_at(pos + 1) & 63) << 6 | (byte_at(pos + 2) & 63)
+            pos += 3
+            if cp > 0xFFFF:
+                cp -= 0x10000
+                units.append(cp >> 10 & 1023 | 0xD800)
+                cp = 0xDC00 | cp & 1023
+            units.append(cp)
+        else:
+            units.append(b)
+    text = ''.join(map(chr, (u & 0xFFFF for u in units)))
+    return text.encode('utf-16-le', 'surrogatepass').decode('utf-16-le', 'replace'), pos
+
+
+class MessagePackDecoder:
+    """单次遍历缓冲区的 MessagePack 解码器"""
+
+    def __init__(self, buf):
+        self.buf = buf
+        self.end = len(buf)
+        self.pos = 0
+        self.has_float = False
+
+    def _need(self, n, message=_OUT_OF_BOUNDS):
+        if self.pos + n > self.end:
+            raise MessagePackDecodeError(message)
+
+    def _read_str(self, length):
+        self._need(length, _UNEXPECTED_END)
+        start = self.pos
+        raw = self.buf[start:start + length]
+        try:
+            self.pos = start + length
+            return raw.decode('utf-8')
+        except UnicodeDecodeError:
+            if length > 64:
+                # JS 中长字符串走 TextDecoder，非法字节替换为 U+FFFD
+                return raw.decode('utf-8', 'replace')
+            text, self.pos = _lenient_utf8(self.buf, start, length)
+            if self.pos > self.end:
+                raise MessagePackDecodeError(_UNEXPECTED_END)
+            return text
+
+    def _number(self, value):
+        value = _js_number(value)
+        if isinstance(value, float):
+            self.has_float = True
+        return value
+
+    def _read_map(self, size):
+        buf = self.buf
+        result = {}
+        needs_reorder = False
+        seen_plain_key = False
+        last_index = -1
+        for _ in range(size):
+            token = buf[self.pos] if self.pos < self.end else None
+            if token is not None and token < 0x80:
+                # 协议中绝大多数键是小整数，走快速路径
+                self.pos += 1
+                key = _SMALL_INT_KEYS[token]
+                index = token
+            else:
+                key = _js_key(self.read())
+                if key == '__proto__':
+                    key = '__proto_'
+                index = int(key) if _is_index_key(key) else None
+            if index is not None:
+                if seen_plain_key or index < last_index:
+                    needs_reorder = True
+                last_index = index
+            else:
+                seen_plain_key = True
+            result[key] = self.read()
+        if needs_reorder:
+            # JS 对象的整数键总是按升序排在前面
+            index_keys = sorted((k for k in result if _is_index_key(k)), key=int)
+            ordered = {k: result[k] for k in index_keys}
+            for k, v in result.items():
+                if k not in ordered:
+                    ordered[k] = v
+            result = ordered
+        return result
+
+    def _read_array(self, size):
+        return [self.read() for _ in range(size)]
+
+    def read(self):
+        """读取一个完整的值"""
+        if self.pos >= self.end:
+            raise MessagePackDecodeError(_UNEXPECTED_END)
+        buf = self.buf
+        token = buf[self.pos]
+        self.pos += 1
+
+        if token < 0x80:
+            return token
+        if token < 0x90:
+            return self._read_map(token - 0x80)
+        if token < 0xA0:
+            return self._read_array(token - 0x90)
+        if token < 0xC0:
+            return self._read_str(token - 0xA0)
+        if token >= 0xE0:
+            return token - 256
+
+        if token == 0xC0:
+            return None
+        if token == 0xC2:
+            return False
+        if token == 0xC3:
+            return True
+        if token == 0xCC:
+            self._need(1, _UNEXPECTED_END)
+            self.pos += 1
+            return buf[self.pos - 1]
+        if token == 0xCD:
+            self._need(2)
+            self.pos += 2
+            return _unpack_u16(buf, self.pos - 2)[0]
+        if token == 0xCE:
+            self._need(4)
+            self.pos += 4
+            return _unpack_u32(buf, self.pos - 4)[0]
+        if token == 0xCF:
+            # uint64 在 JS 中为 BigInt，序列化为字符串
+            self._need(8)
+            self.pos += 8
+            return str(_unpack_u64(buf, self.pos - 8)[0])
+        if token == 0xD0:
+            self._need(1)
+            self.pos += 1
+            return _unpack_i8(buf, self.pos - 1)[0]
+        if token == 0xD1:
+            self._need(2)
+            self.pos += 2
+            return _unpack_i16(buf, self.pos - 2)[0]
+        if token == 0xD2:
+            self._need(4)
+            self.pos += 4
+            return _unpack_i32(buf, self.pos - 4)[0]
+        if token == 0xD3:
+            self._need(8)
+            self.pos += 8
+            return str(_unpack_i64(buf, self.pos - 8)[0])
+        if token == 0xCA:
+            self._need(4)
+            self.pos += 4
+            return self._number(_unpack_f32(buf, self.pos - 4)[0])
+        if token == 0xCB:
+            self._need(8)
+            self.pos += 8
+            return self._number(_unpack_f64(buf, self.pos - 8)[0])
+        if token == 0xD9:
+            self._need(1, _UNEXPECTED_END)
+            self.pos += 1
+            return self._read_str(buf[self.pos - 1])
+        if token == 0xDA:
+            self._need(2)
+            self.pos += 2
+            return self._read_str(_unpack_u16(buf, self.pos - 2)[0])
+        if token == 0xDB:
+            self._need(4)
+            self.pos += 4
+            return self._read_str(_unpack_u32(buf, self.pos - 4)[0])
+        if token == 0xDC:
+            self._need(2)
+            self.pos += 2
+            return self._read_array(_unpack_u16(buf, self.pos - 2)[0])
+        if token == 0xDD:
+            self._need(4)
+            self.pos += 4
+            return self._read_array(_unpack_u32(buf, self.pos - 4)[0])
+        if token == 0xDE:
+            self._need(2)
+            self.pos += 2
+            return self._read_map(_unpack_u16(buf, self.pos - 2)[0])
+        if token == 0xDF:
+            self._need(4)
+            self.pos += 4
+            return self._read_map(_unpack_u32(buf, self.pos - 4)[0])
+        # bin / ext 类型在闲鱼协议中未使用，JS 实现同样不支持
+        raise MessagePackDecodeError(f"Unknown MessagePack token {token}")
+
+    def decode(self):
+        """解码整个缓冲区，要求恰好读完"""
+        result = self.read()
+        if self.pos < self.end:
+            preview = json.dumps(result, ensure_ascii=False, separators=(',', ':'))[:100]
+            raise MessagePackDecodeError(f"Data read, but end of buffer not reached {preview}")
+        return result
+
+
+def b64_to_bytes(data):
+    """与 JS atob(rW(data)) 一致：忽略非 base64 字符，补齐填充"""
+    cleaned = _NON_BASE64.sub('', data)
+    if len(cleaned) % 4 == 1:
+        raise MessagePackDecodeError("The string to be decoded is not correctly encoded.")
+    cleaned += '=' * (-len(cleaned) % 4)
+    return base64.b64decode(cleaned)
+
+
+def unpackb(buf):
+    """解码 MessagePack 字节串，返回 Python 对象"""
+    return MessagePackDecoder(buf).decode()
+
+
+def decrypt(data):
+    """解码 base64 编码的 MessagePack 数据，返回与 JS 版本一致的 JSON 字符串"""
+    decoder = MessagePackDecoder(b64_to_bytes(data))
+    result = decoder.decode()
+    if decoder.has_float:
+        return _dumps_js(result)
+    return json.dumps(result, ensure_ascii=False, separators=(',', ':'))
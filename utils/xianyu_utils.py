@@ -1,13 +1,71 @@
 import json
+import os
+import time
+import random
+import hashlib
 import subprocess
 from functools import partial
 subprocess.Popen = partial(subprocess.Popen, encoding="utf-8")
 import execjs
+from utils import msgpack_decoder
+from utils.js_pool import JSEnginePool, STATIC_DIR
+
+# 签名/设备号/解密等算法的实现方式：
+#   native  纯Python实现（默认）
+#   pool    常驻Node进程池，脚本只加载一次
+#   execjs  每次调用启动Node子进程
+UTILS_BACKEND = os.getenv('XIANYU_UTILS_BACKEND', 'native').lower()
+# 使用的JS脚本版本，对应 static/xianyu_js_version_{N}.js
+JS_VERSION = os.getenv('XIANYU_JS_VERSION', '2')
+JS_POOL_SIZE = int(os.getenv('XIANYU_JS_POOL_SIZE', '4'))
+
+APP_KEY = '34839810'
+_DEVICE_ID_CHARS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+
+_xianyu_js = None
+_js_pool = None
+
+
+def _script_path():
+    return os.path.join(STATIC_DIR, f'xianyu_js_version_{JS_VERSION}.js')
+
+
+def _get_xianyu_js():
+    """按需编译JS脚本，native模式下不依赖Node环境"""
+    global _xianyu_js
+    if _xianyu_js is None:
+        with open(_script_path(), 'r', encoding='utf-8') as f:
+            _xianyu_js = execjs.compile(f.read())
+    return _xianyu_js
+
+
+def _get_js_pool():
+    global _js_pool
+    if _js_pool is None:
+        _js_pool = JSEnginePool(_script_path(), size=JS_POOL_SIZE)
+    return _js_pool
+
+
+def _js_call(fn, *args):
+    if UTILS_BACKEND == 'pool':
+        return _get_js_pool().call(fn, *args)
+    return _get_xianyu_js().call(fn, *args)
+
+
+# execjs 模式下在一次Node调用内完成批量执行，返回结构与进程池的批量响应一致
+_JS_BATCH_CALL = """(function (fn, batch) {
+    return batch.map(function (args) {
+        try { return {result: eval(fn).apply(null, args)}; }
+        catch (e) { return {error: String(e)}; }
+    });
+})"""
+
+
+def _js_call_batch(fn, batch):
+    if UTILS_BACKEND == 'pool':
+        return _get_js_pool().call_batch(fn, batch)
+    return _get_xianyu_js().call(_JS_BATCH_CALL, fn, batch)
 
-try:
-    xianyu_js = execjs.compile(open(r'../static/xianyu_js_version_2.js', 'r', encoding='utf-8').read())
-except:
-    xianyu_js = execjs.compile(open(r'static/xianyu_js_version_2.js', 'r', encoding='utf-8').read())
 
 def trans_cookies(cookies_str):
     cookies = dict()
@@ -19,22 +77,138 @@ def trans_cookies(cookies_str):
     return cookies
 
 
+def _native_generate_mid():
+    # 与JS一致: Math.floor(1e3 * Math.random()) + Date.now() + " 0"
+    return f"{random.randint(0, 999)}{int(time.time() * 1000)} 0"
+
+
+def _native_generate_uuid():
+    # 与JS一致: "-" + Date.now() + "1"
+    return f"-{int(time.time() * 1000)}1"
+
+
+def _native_generate_device_id(user_id):
+    # UUID v4 格式，第19位取 (r & 3 | 8)
+    chars = []
+    for i in range(36):
+        if i in (8, 13, 18, 23):
+            chars.append("-")
+        elif i == 14:
+            chars.append("4")
+        else:
+            r = random.randrange(16)
+            chars.append(_DEVICE_ID_CHARS[(r & 3) | 8 if i == 19 else r])
+    return "".join(chars) + "-" + str(user_id)
+
+
+def _native_generate_sign(t, token, data):
+    msg = f"{token}&{t}&{APP_KEY}&{data}"
+    return hashlib.md5(msg.encode('utf-8')).hexdigest()
+
+
 def generate_mid():
-    mid = xianyu_js.call('generate_mid')
-    return mid
+    if UTILS_BACKEND == 'native':
+        return _native_generate_mid()
+    return _js_call('generate_mid')
 
 def generate_uuid():
-    uuid = xianyu_js.call('generate_uuid')
-    return uuid
+    if UTILS_BACKEND == 'native':
+        return _native_generate_uuid()
+    return _js_call('generate_uuid')
 
 def generate_device_id(user_id):
-    device_id = xianyu_js.call('generate_device_id', user_id)
-    return device_id
+    if UTILS_BACKEND == 'native':
+        return _native_generate_device_id(user_id)
+    return _js_call('generate_device_id', user_id)
 
 def generate_sign(t, token, data):
-    sign = xianyu_js.call('generate_sign', t, token, data)
-    return sign
+    if UTILS_BACKEND == 'native':
+        return _native_generate_sign(t, token, data)
+    return _js_call('generate_sign', t, token, data)
 
 def decrypt(data):
-    res = xianyu_js.call('decrypt', data)
-    return res
+    if UTILS_BACKEND == 'native':
+        return msgpack_decoder.decrypt(data)
+    return _js_call('decrypt', data)
+
+def decrypt_many(payloads):
+    """
+    批量解密同一同步包内的多条数据
+
+    Args:
+        payloads: 加密数据列表
+
+    Returns:
+        list: 与输入顺序一致的 (结果, 错误) 列表，成功时错误为None，失败时结果为None
+    """
+    if UTILS_BACKEND == 'native':
+        results = []
+        for data in payloads:
+            try:
+                results.append((msgpack_decoder.decrypt(data), None))
+            except Exception as e:
+                results.append((None, e))
+        return results
+    try:
+        responses = _js_call_batch('decrypt', [[data] for data in payloads])
+    except Exception as e:
+        return [(None, e) for _ in payloads]
+    return [(r['result'], None) if 'error' not in r else (None, RuntimeError(r['error'])) for r in responses]
+
+
+if __name__ == '__main__':
+    # 对比JS实现：校验结果一致性并测量单次调用耗时
+    import re
+    import timeit
+
+    js = _get_xianyu_js()
+    samples = [
+        ('1745000000000', '5f65b00f83994987e334f97360d69557', '{"sessionTypes":"1,19"}'),
+        ('1745000000001', 'abc', '{"itemId":"897742748011"}'),
+        ('1745000000002', 'token', '{"text":"你好，还在吗"}'),
+    ]
+    for t, token, data in samples:
+        assert _native_generate_sign(t, token, data) == js.call('generate_sign', t, token, data), (t, token, data)
+    mid_re = re.compile(r'^\d{13,16} 0$')
+    uuid_re = re.compile(r'^-\d{13}1$')
+    device_re = re.compile(r'^[0-9A-F]{8}-[0-9A-F]{4}-4[0-9A-F]{3}-[89AB][0-9A-F]{3}-[0-9A-F]{12}-(.+)$')
+    for mid in (_native_generate_mid(), js.call('generate_mid')):
+        assert mid_re.match(mid), mid
+    for uuid in (_native_generate_uuid(), js.call('generate_uuid')):
+        assert uuid_re.match(uuid), uuid
+    for device_id in (_native_generate_device_id('2202640918079'), js.call('generate_device_id', '2202640918079')):
+        match = device_re.match(device_id)
+        assert match and match.group(1) == '2202640918079', device_id
+
+    # 解密黄金样本：由 JS decrypt() 生成，包含脚本内的示例数据
+    golden_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'static', 'decrypt_golden.json')
+    with open(golden_path, 'r', encoding='utf-8') as f:
+        golden = json.load(f)
+    for case in golden:
+        try:
+            result = msgpack_decoder.decrypt(case['data'])
+        except msgpack_decoder.MessagePackDecodeError as e:
+            assert str(e) == case.get('error'), (case['name'], str(e))
+        else:
+            assert result == case.get('expected'), (case['name'], result)
+    print("native 与 JS 实现结果一致")
+
+    # 吞吐对比：execjs / 常驻进程池 / native，单位为次/秒
+    from concurrent.futures import ThreadPoolExecutor
+
+    pool = _get_js_pool()
+    sample = golden[1]['data']
+    cases = [('generate_sign', samples[0], _native_generate_sign),
+             ('decrypt', (sample,), msgpack_decoder.decrypt)]
+    for name, args, native_func in cases:
+        assert pool.call(name, *args) == js.call(name, *args)
+        execjs_rate = 10 / timeit.timeit(lambda: js.call(name, *args), number=10)
+        pool_rate = 1000 / timeit.timeit(lambda: pool.call(name, *args), number=1000)
+        with ThreadPoolExecutor(max_workers=JS_POOL_SIZE) as executor:
+            started = time.perf_counter()
+            list(executor.map(lambda _: pool.call(name, *args), range(2000)))
+            pool_parallel_rate = 2000 / (time.perf_counter() - started)
+        native_rate = 2000 / timeit.timeit(lambda: native_func(*args), number=2000)
+        print(f"{name:<14} execjs: {execjs_rate:10.1f} 次/秒   pool: {pool_rate:10.1f} 次/秒   "
+              f"pool x{JS_POOL_SIZE}线程: {pool_parallel_rate:10.1f} 次/秒   native: {native_rate:10.1f} 次/秒")
+    pool.close()
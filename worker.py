@@ -1,242 +1,531 @@
+import re
 import time
 import json
-import threading
-from loguru import logger
 import asyncio
+from functools import partial
+from loguru import logger
+from message_queue import consumer_name
+import metrics
+from order_events import ORDER_STATUS_MESSAGES
+from message_handler import conversation_key
+
+# 聊天消息链接中的商品ID
+_ITEM_ID = re.compile(r'itemId=(\d+)')
 
 
+async def run_blocking(self, func, *args, **kwargs):
+    """在有界线程池中执行阻塞调用（Redis/MySQL/HTTP），避免阻塞事件循环"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+
 def start_workers(self):
-    """启动工作线程"""
-    for i in range(self.max_workers):
-        thread = threading.Thread(
-            target=self.message_worker,
-            name=f'MessageWorker-{i}',
-            daemon=True
-        )
-        thread.start()
-        self.worker_threads.append(thread)
-    logger.info(f"已启动 {self.max_workers} 个工作线程")
-
-def stop_workers(self):
-    """停止工作线程"""
-    self.stop_event.set()
-    for thread in self.worker_threads:
-        thread.join(timeout=5)
-    self.worker_threads.clear()
-    self.stop_event.clear()
-    logger.info("所有工作线程已停止")
-
-def message_worker(self):
-    """消息处理工作线程"""
+    """在当前事件循环中启动会话处理槽、消息分发、批量回复、订单处理和出站写任务"""
+    self.stop_event = asyncio.Event()
+    self.queue_event = asyncio.Event()
+    self.debounce_event = asyncio.Event()
+    self.order_event = asyncio.Event()
+    self.retry_event = asyncio.Event()
+    self.slots.start()
+    self.worker_tasks.append(asyncio.create_task(self.message_worker(), name='MessageWorker'))
+    self.worker_tasks.append(asyncio.create_task(self.batch_process_messages(), name='BatchProcessor'))
+    self.worker_tasks.append(asyncio.create_task(self.process_order_events(), name='OrderEventProcessor'))
+    self.worker_tasks.append(asyncio.create_task(self.retry_mover(), name='RetryMover'))
+    self.worker_tasks.append(asyncio.create_task(self.outbound.run(), name='OutboundWriter'))
+    self.worker_tasks.append(asyncio.create_task(self.metrics_reporter(), name='MetricsReporter'))
+    logger.info(f"已启动 {self.slots.size} 个会话处理槽")
+
+async def stop_workers(self):
+    """停止所有后台任务"""
+    if self.stop_event:
+        self.stop_event.set()
+    for task in self.worker_tasks + list(self.pending_messages) + list(self.reply_tasks):
+        task.cancel()
+    await asyncio.gather(*self.worker_tasks, *self.pending_messages, *self.reply_tasks, return_exceptions=True)
+    self.worker_tasks.clear()
+    self.pending_messages.clear()
+    self.reply_tasks.clear()
+    await self.slots.stop()
+    self.executor.shutdown(wait=False)
+    logger.info("所有后台任务已停止")
+
+async def message_worker(self):
+    """消息分发任务：按队列顺序取消息并解密，逐条按会话提交到处理槽
+
+    只有一个分发任务按顺序提交，同一会话的消息在其处理槽中保持先后顺序；
+    整包处理完成后由 complete_message 确认或安排重试
+    """
+    consumer = consumer_name(0)
+    while not self.stop_event.is_set():
+        try:
+            # 从消息队列中获取消息（非阻塞），队列为空时等待新消息通知
+            items = await self.run_blocking(self.message_queue.fetch, consumer, self.message_fetch_batch)
+
+            if not items:
+                self.queue_event.clear()
+                try:
+                    # 其他进程写入的消息没有本地通知，最多等待1秒后再次检查
+                    await asyncio.wait_for(self.queue_event.wait(), timeout=1)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            for handle, message_data in items:
+                try:
+                    # 解析并解密消息数据
+                    data = json.loads(message_data)
+                    messages, errors = await self.decrypt_sync_package(data['message'])
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    data, messages, errors = None, [], [(None, str(e))]
+
+                # 按会话提交，处理槽邮箱已满时在此等待
+                futures = []
+                for sync_data, message in messages:
+                    self.cancel_obsolete_reply(message)
+                    futures.append((sync_data, await self.slots.submit(
+                        conversation_key(message),
+                        self._handle_sync_message,
+                        message,
+                        data.get('resumed', False),
+                        data.get('timestamp')
+                    )))
+                task = asyncio.create_task(self.complete_message(handle, message_data, data, futures, errors))
+                self.pending_messages.add(task)
+                task.add_done_callback(self.pending_messages.discard)
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"消息处理任务发生错误: {str(e)}")
+            await asyncio.sleep(1)  # 发生错误时等待1秒后继续
+
+def cancel_obsolete_reply(self, message):
+    """买家在回复生成期间发来新消息时，取消该会话正在进行的生成"""
+    if not self.is_chat_message(message) or message['1'].get('7') == 1:
+        return
+    if message['1']['10'].get('senderUserId') == self.myid:
+        return
+    generation = self.generations.get(conversation_key(message))
+    if generation and not generation.done():
+        generation.cancel()
+
+async def complete_message(self, handle, message_data, envelope, futures, errors):
+    """等待同一包内所有消息处理完成，全部成功则确认，否则只把失败的数据安排重试
+
+    errors 为 [(原始数据, 错误)]，原始数据为 None 表示整个信封无法处理
+    """
+    errors = list(errors)
+    results = await asyncio.gather(*(future for _, future in futures), return_exceptions=True)
+    for (sync_data, _), result in zip(futures, results):
+        if isinstance(result, BaseException):
+            errors.append((sync_data, str(result)))
+    try:
+        if not errors:
+            await self.run_blocking(self.message_queue.ack, handle)
+            return
+        error = f"同步包中 {len(errors)} 条消息处理失败: {'; '.join(e for _, e in errors)}"
+        logger.error(f"处理消息时发生错误: {error}")
+        # 确认原消息并安排延迟重试，超过最大次数写入死信队列
+        payload = failed_envelope(envelope, [sync_data for sync_data, _ in errors]) or message_data
+        if await self.run_blocking(self.retry_queue.fail, handle, payload, error) == 'retry':
+            self.retry_event.set()
+    except Exception as e:
+        logger.error(f"确认消息时发生错误: {str(e)}")
+
+def failed_envelope(envelope, failed):
+    """只保留失败数据的重试信封，已成功处理的数据重试时不会再次入库和回复
+
+    信封无法解析（failed 中有 None）时返回 None，由调用方使用原始信封
+    """
+    if envelope is None or any(sync_data is None for sync_data in failed):
+        return None
+    message = envelope['message']
+    package = message['body']['syncPushPackage']
+    data = [sync_data for sync_data in package['data'] if any(sync_data is f for f in failed)]
+    return json.dumps({
+        **envelope,
+        'message': {**message, 'body': {**message['body'], 'syncPushPackage': {**package, 'data': data}}}
+    })
+
+async def retry_mover(self):
+    """重试任务：把到期的失败消息放回消息队列"""
     while not self.stop_event.is_set():
         try:
-            # 从Redis队列中获取消息
-            message_data = self.redis_client.brpoplpush(
-                self.message_queue_key,
-                self.processing_queue_key,
-                timeout=1
-            )
-            
-            if not message_data:
+            self.retry_event.clear()
+            moved = await self.run_blocking(self.retry_queue.move_due, time.time())
+            if moved:
+                logger.info(f"已将 {moved} 条到期的失败消息放回队列")
+                self.queue_event.set()
                 continue
-            
+            await self.run_blocking(self.retry_queue.update_depth)
+
+            # 休眠到下一个重试时间；其他进程写入的重试没有本地通知，最多休眠1秒
+            next_due = await self.run_blocking(self.retry_queue.next_due)
+            timeout = 1 if next_due is None else min(1, max(0.0, next_due - time.time()))
             try:
-                # 解析消息数据
-                data = json.loads(message_data)
-                message = data['message']
-                websocket = self.ws  # 使用当前的WebSocket连接
-                
-                # 处理消息
-                asyncio.run(self._handle_message(message, websocket))
-                
-                # 处理完成后从处理队列中移除
-                self.redis_client.lrem(self.processing_queue_key, 0, message_data)
-                
-            except Exception as e:
-                logger.error(f"处理消息时发生错误: {str(e)}")
-                # 将处理失败的消息移回主队列
-                self.redis_client.lpush(self.message_queue_key, message_data)
-                self.redis_client.lrem(self.processing_queue_key, 0, message_data)
-                
+                await asyncio.wait_for(self.retry_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            logger.error(f"工作线程发生错误: {str(e)}")
-            time.sleep(1)  # 发生错误时等待1秒后继续
+            logger.error(f"重试任务发生错误: {str(e)}")
+            await asyncio.sleep(1)
 
-def batch_process_messages(self):
-    """处理达到5秒时间阈值的order_id消息"""
-    while True:
+async def metrics_reporter(self):
+    """指标任务：定期导出各通道的队列积压，并输出队列、处理槽与大模型后端的状态
+
+    每次同时把全部指标（metrics.snapshot()，含重连、心跳、重试/死信等计数和直方图）以 JSON 写入日志
+    """
+    while not self.stop_event.is_set():
         try:
-            current_time = time.time()
-            
-            # 获取所有活跃的order_id
-            pattern = f"{self.chat_messages_key}:*"
-            order_keys = self.redis_client.keys(pattern)
-            
-            for order_key in order_keys:
-                try:
-                    order_id = order_key.split(':')[2]
-                    
-                    # 检查是否已经过了阈值
-                    first_message_time = self.order_first_message_time.get(order_id)
-                    if not first_message_time or (current_time - first_message_time) < self.message_batch_threshold:
-                        continue  # 跳过未到阈值的order_id
-                        
-                    # 获取Redis中该order_id的所有消息
-                    messages = []
-                    while True:
-                        msg_data = self.redis_client.rpop(order_key)
-                        if not msg_data:
-                            break
-                        messages.append(json.loads(msg_data))
-                    
-                    if not messages:
-                        # 清理首次消息时间记录
-                        self.order_first_message_time.pop(order_id, None)
-                        continue
-                        
-                    # 按时间排序
-                    messages.sort(key=lambda x: x['timestamp'])
-                    
-                    # 获取MySQL中最近5条历史消息
-                    history_messages = self.db_manager.get_chat_messages(
-                        order_id=order_id,
-                        limit=5
-                    )
-                    
-                    # 构建完整对话上下文
-                    context = []
-                    
-                    # 添加历史消息
-                    for msg in history_messages:
-                        context.append(f"[历史消息] {msg['user_name']}: {msg['chat']}")
-                    
-                    # 添加Redis中的新消息
-                    for msg in messages:
-                        context.append(f"{msg['user_name']}: {msg['chat']}")
-                    
-                    # 合并上下文
-                    full_context = "\n".join(context)
-                    print(full_context)
-                    
-                    # 生成回复
-                    bot_reply = self.bot.generate(
-                        user_msg=full_context,
-                        user_id=messages[-1]['user_id'],
-                        order_id=order_id
-                    )
-                    
-                    # 保存所有新消息到MySQL
-                    for msg in messages:
-                        self.db_manager.save_chat_message(
-                            user_id=msg['user_id'],
-                            user_name=msg['user_name'],
-                            local_id=msg['local_id'],
-                            chat=msg['chat'],
-                            url=msg['url'],
-                            order_id=msg['order_id'],
-                            chat_type=msg.get('chat_type', 'text'),
-                            city=msg.get('city', None),
-                            country=msg.get('country', None),
-                            platform=msg.get('platform', None),
-                            client_ip=msg.get('client_ip', None)
-                        )
-                    
-                    # 保存机器人回复到MySQL
-                    self.db_manager.save_chat_message(
-                        user_id=messages[-1]['user_id'],
-                        user_name="me",
-                        local_id=self.myid,
-                        chat=bot_reply,
-                        url=messages[-1]['url'],
-                        order_id=order_id,
-                        chat_type='text',
-                        city=messages[-1].get('city', None),
-                        country=messages[-1].get('country', None),
-                        platform=messages[-1].get('platform', None),
-                        client_ip=messages[-1].get('client_ip', None)
-                    )
-                    
-                    # 发送回复
-                    asyncio.run(self.send_msg(
-                        self.ws,
-                        order_id,
-                        messages[-1]['user_id'],
-                        bot_reply
-                    ))
-                    
-                    logger.info(f"批量处理完成 - order_id: {order_id}, reply: {bot_reply}")
-                    
-                    # 清理已处理的order_id的首次消息时间
-                    self.order_first_message_time.pop(order_id, None)
-                    
-                except Exception as e:
-                    logger.error(f"处理order_id {order_id}的消息时出错: {str(e)}")
-                    # 出错时也清理首次消息时间，避免消息卡住
-                    self.order_first_message_time.pop(order_id, None)
-            
-            # 短暂休眠以减少CPU使用
-            time.sleep(0.1)
-            
+            depths = await self.run_blocking(self.message_queue.depths)
+            for lane, depth in depths.items():
+                metrics.set_gauge(f'queue.depth.{lane}', depth)
+            backlog = sum(self.slots.backlog())
+            metrics.set_gauge('slots.backlog', backlog)
+            status = f"队列积压 {depths}，处理槽积压 {backlog}"
+            health = getattr(self.bot, 'health', None)
+            if health:
+                status += f"，{health.summary()}"
+            logger.info(f"运行状态: {status}")
+            logger.info(f"运行指标: {json.dumps(metrics.snapshot(), ensure_ascii=False, sort_keys=True)}")
         except Exception as e:
-            logger.error(f"批量处理消息时发生错误: {str(e)}")
-            time.sleep(0.1)
+            logger.error(f"导出运行指标时发生错误: {str(e)}")
+        try:
+            await asyncio.wait_for(self.stop_event.wait(), self.metrics_interval)
+        except asyncio.TimeoutError:
+            pass
+
+async def batch_process_messages(self):
+    """为达到5秒时间阈值的order_id启动回复任务
 
-def process_wait_ship_orders(self):
-    """每10秒检测是否有等待卖家发货的订单，并进行回复"""
+    回复生成（大模型调用）不占用会话处理槽，只有保存和发送回到该会话的槽中执行，
+    慢的生成不会阻塞同一槽内其他会话的消息入库
+    """
     while True:
         try:
-            # 查找所有等待卖家发货的订单
-            keys = self.redis_client.keys("xianyu:order_wait_ship:*")
-            for key in keys:
-                order_id = key.split(":")[-1]
-                # 检查key是否还存在（防止被其他线程消费）
-                if not self.redis_client.exists(key):
-                    continue
+            # 先清除唤醒标记，之后新登记的会话或处理完成的会话会再次唤醒
+            self.debounce_event.clear()
 
-                # 从数据库 chat_message 检索 user_id 和 local_id
-                # 取最新一条消息
-                chat_msgs = self.db_manager.get_chat_messages(order_id=order_id, limit=1)
-                if not chat_msgs:
-                    logger.warning(f"未找到order_id={order_id}的聊天消息，无法自动回复")
-                    self.redis_client.delete(key)
+            # 只取出已到期的order_id，已提交未完成的跳过
+            due_orders = await self.run_blocking(self.debounce.due, time.time())
+            submitted = False
+            for order_id in due_orders:
+                if order_id in self.batch_inflight:
                     continue
+                self.batch_inflight.add(order_id)
+                task = asyncio.create_task(self.process_due_order(order_id))
+                self.reply_tasks.add(task)
+                task.add_done_callback(self.reply_tasks.discard)
+                submitted = True
+
+            if submitted:
+                continue
+
+            # 休眠到下一个到期时间；其他进程登记的会话没有本地通知，最多休眠 debounce_max_sleep 秒
+            next_due = await self.run_blocking(self.debounce.next_due)
+            timeout = self.debounce_max_sleep if next_due is None else min(self.debounce_max_sleep, max(0.0, next_due - time.time()))
+            if self.batch_inflight and timeout == 0:
+                # 到期的会话都在处理中，等待处理完成
+                timeout = self.debounce_max_sleep
+            try:
+                await asyncio.wait_for(self.debounce_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"批量处理消息时发生错误: {str(e)}")
+            await asyncio.sleep(1)
+
+async def process_due_order(self, order_id):
+    """合并该order_id的新消息并生成回复"""
+    try:
+        # 获取会话租约，其他进程正在处理该会话时跳过
+        token = await self.run_blocking(self.debounce.acquire, order_id, time.time())
+        if token is None:
+            logger.debug(f"order_id {order_id} 正由其他进程处理，稍后重试")
+            return
+        try:
+            await self.reply_to_order(order_id, token)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"处理order_id {order_id}的消息时出错: {str(e)}")
+        finally:
+            await self.run_blocking(self.debounce.release, order_id, token)
+    finally:
+        self.batch_inflight.discard(order_id)
+        self.debounce_event.set()
+
+async def reply_to_order(self, order_id, token):
+    """持有租约时取出该order_id的所有消息，生成回复后在会话处理槽中保存并发送
+
+    消息在发送成功前一直保存在处理中列表，中途崩溃或租约失效时由下一个持有者重新处理
+    """
+    order_key = f"{self.chat_messages_key}:{order_id}"
+
+    # 一次往返原子地校验令牌并把新消息移入处理中列表（已按时间排序）
+    drained = await self.run_blocking(self.debounce.drain, order_id, order_key, token)
+    if drained is None:
+        metrics.inc('debounce.lease_lost')
+        return
+    messages = [json.loads(msg_data) for msg_data in drained]
+
+    if not messages:
+        await self.run_blocking(self.debounce.complete, order_id, order_key, token, time.time())
+        return
+
+    # 已有 Dify 会话时由 Dify 保存对话历史，只发送新消息；否则拼接MySQL中最近5条历史消息
+    user_id = messages[-1]['user_id']
+    conversation_id = await self.run_blocking(self.dify_conversations.get, user_id, order_id)
+    history_messages = []
+    if not conversation_id:
+        history_messages = await self.run_blocking(
+            self.db_manager.get_chat_messages,
+            order_id=order_id,
+            limit=5
+        )
+
+    # 只缓存不依赖买家上下文的回复：首轮对话（没有 Dify 会话和历史消息）。
+    # 命中缓存的问答照常存入MySQL，下一轮通过历史消息带给 Dify
+    cache_key = None if conversation_id or history_messages else self.reply_cache_key(order_id, messages)
+
+    # 构建完整对话上下文
+    context = []
+
+    # 添加历史消息
+    for msg in history_messages:
+        context.append(f"[历史消息] {msg['user_name']}: {msg['chat']}")
+
+    # 添加Redis中的新消息；可缓存的回复会发给其他买家，不带买家昵称
+    for msg in messages:
+        context.append(f"{'买家' if cache_key else msg['user_name']}: {msg['chat']}")
+
+    # 合并上下文
+    full_context = "\n".join(context)
+    logger.debug(full_context)
+
+    async def call_bot():
+        reply = await self.bot.achat(
+            user_msg=full_context,
+            user_id=user_id,
+            order_id=order_id,
+            conversation_id=conversation_id
+        )
+        if reply.conversation_id:
+            # 记录（或续期）该买家与订单的 Dify 会话
+            await self.run_blocking(self.dify_conversations.save, user_id, order_id, reply.conversation_id)
+        return reply.answer
+
+    # 生成回复（可缓存的问题先查回复缓存）；生成期间买家发来新消息时由分发任务取消，
+    # 本批消息放回列表与新消息合并后重新生成
+    generation = asyncio.create_task(self.reply_cache.aget_or_create(cache_key, call_bot))
+    self.generations[order_id] = generation
+    try:
+        await asyncio.wait({generation})
+    except asyncio.CancelledError:
+        generation.cancel()
+        raise
+    finally:
+        self.generations.pop(order_id, None)
+
+    if generation.cancelled():
+        metrics.inc('reply.cancelled')
+        logger.info(f"order_id {order_id} 有新消息，取消本次回复并与新消息合并")
+        # 本批消息留在处理中列表，到期后与新消息一起重新取出
+        await self.run_blocking(self.debounce.reschedule, order_id, time.time() + self.message_batch_threshold)
+        return
+    bot_reply = generation.result()
+
+    # 保存和发送回到会话处理槽中执行，与该会话的消息入库保持顺序
+    delivered = await self.slots.submit(order_id, self.deliver_reply, order_id, order_key, token, messages, bot_reply)
+    await delivered
+
+async def deliver_reply(self, order_id, order_key, token, messages, bot_reply):
+    """在会话处理槽中校验租约，保存本批消息和回复并发送"""
+    # 保存和发送前原子地校验令牌并续期租约：生成期间租约已过期并被其他进程获取时放弃本次回复，
+    # 消息仍在处理中列表，由新的持有者合并处理
+    if not await self.run_blocking(self.debounce.renew, order_id, token):
+        metrics.inc('debounce.lease_lost')
+        logger.warning(f"order_id {order_id} 的租约已失效，放弃本次回复")
+        return
+
+    # 保存所有新消息到MySQL
+    for msg in messages:
+        await self.run_blocking(
+            self.db_manager.save_chat_message,
+            user_id=msg['user_id'],
+            user_name=msg['user_name'],
+            local_id=msg['local_id'],
+            chat=msg['chat'],
+            url=msg['url'],
+            order_id=msg['order_id'],
+            chat_type=msg.get('chat_type', 'text'),
+            city=msg.get('city', None),
+            country=msg.get('country', None),
+            platform=msg.get('platform', None),
+            client_ip=msg.get('client_ip', None)
+        )
+
+    # 保存机器人回复到MySQL
+    await self.run_blocking(
+        self.db_manager.save_chat_message,
+        user_id=messages[-1]['user_id'],
+        user_name="me",
+        local_id=self.myid,
+        chat=bot_reply,
+        url=messages[-1]['url'],
+        order_id=order_id,
+        chat_type='text',
+        city=messages[-1].get('city', None),
+        country=messages[-1].get('country', None),
+        platform=messages[-1].get('platform', None),
+        client_ip=messages[-1].get('client_ip', None)
+    )
 
-                msg = chat_msgs[0]
-                user_id = msg['user_id'] if isinstance(msg, dict) else msg[1]
-                local_id = msg['local_id'] if isinstance(msg, dict) else msg[3]
-
-                # 生成回复
-                reply = self.bot.generate(
-                    user_msg="您的订单已付款，卖家会尽快发货，请耐心等待。",
-                    user_id=user_id,
-                    order_id=order_id
-                )
-
-                # 保存机器人回复到MySQL
-                self.db_manager.save_chat_message(
-                    user_id=user_id,
-                    user_name="me",
-                    local_id=local_id,
-                    chat=reply,
-                    url=None,
-                    order_id=order_id,
-                    chat_type='text'
-                )
-
-                # 发送消息
-                asyncio.run(self.send_msg(
-                    self.ws,
-                    order_id,
-                    user_id,
-                    reply
-                ))
-
-                logger.info(f"已自动回复等待卖家发货订单: {order_id}")
-
-                # 删除已处理的key
-                self.redis_client.delete(key)
-
-            time.sleep(10)
+    # 发送回复
+    await self.send_msg(
+        self.ws,
+        order_id,
+        messages[-1]['user_id'],
+        bot_reply
+    )
+
+    # 发送成功后才删除处理中列表；处理期间的新消息重新开始防抖
+    await self.run_blocking(
+        self.debounce.complete, order_id, order_key, token, time.time() + self.message_batch_threshold
+    )
+    logger.info(f"批量处理完成 - order_id: {order_id}, reply: {bot_reply}")
+
+def reply_cache_key(self, order_id, messages):
+    """回复缓存键：只缓存买家的纯文本、非议价问题；商品取自消息链接中的 itemId，没有时使用会话"""
+    if any(msg['user_id'] == self.myid or msg.get('chat_type', 'text') != 'text' for msg in messages):
+        return None
+    question = "\n".join(msg['chat'] for msg in messages)
+    intent = self.intent_router.match_rules(question) or 'default'
+    if intent == 'price' or self.intent_router.mentions_price(question):
+        return None
+    match = _ITEM_ID.search(messages[-1].get('url') or '')
+    scope = f"item:{match.group(1)}" if match else f"order:{order_id}"
+    return self.reply_cache.key(scope, intent, question)
+
+async def process_order_events(self):
+    """订单事件处理任务：事件发布后立即处理，队列为空时等待新事件通知"""
+    consumer = consumer_name('orders')
+    while not self.stop_event.is_set():
+        try:
+            events = await self.run_blocking(self.order_events.fetch, consumer)
+            if not events:
+                self.order_event.clear()
+                try:
+                    # 其他进程发布的事件没有本地通知，最多等待1秒后再次检查
+                    await asyncio.wait_for(self.order_event.wait(), timeout=1)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            # 按订单提交到会话处理槽，同一订单的事件依次处理
+            for handle, event in events:
+                await self.slots.submit(event['order_id'], self.process_order_event, handle, event)
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"订单事件处理任务发生错误: {str(e)}")
+            await asyncio.sleep(1)
+
+async def process_order_event(self, handle, event):
+    """在会话处理槽中处理一个订单事件并确认"""
+    order_id, status = event['order_id'], event['status']
+    try:
+        # 幂等：同一个订单事件只处理一次，重复投递时跳过
+        if not await self.run_blocking(self.order_events.begin, event):
+            if await self.run_blocking(self.order_events.state, event) == 'done':
+                logger.info(f"订单事件已处理过，跳过: {order_id} -> {status}")
+                metrics.inc('order_events.duplicate')
+                await self.run_blocking(self.order_events.ack, handle)
+            else:
+                # 仍在被其他处理任务处理：不确认，超时后再次认领；原处理失败时由认领方重新处理
+                logger.info(f"订单事件正在被处理，稍后重试: {order_id} -> {status}")
+                metrics.inc('order_events.in_progress')
+            return
+        try:
+            await self.handle_order_event(event)
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            logger.error(f"处理等待卖家发货订单时出错: {str(e)}")
-            time.sleep(10) 
\ No newline at end of file
+            logger.error(f"处理订单事件时出错: {order_id} -> {status}: {e}")
+            await self.run_blocking(self.order_events.abort, event)
+            await self.run_blocking(self.order_events.nack, handle)
+            return
+        await self.run_blocking(self.order_events.finish, event)
+        await self.run_blocking(self.order_events.ack, handle)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"确认订单事件时出错: {order_id} -> {status}: {e}")
+
+async def handle_order_event(self, event):
+    """更新订单状态、保存订单消息，买家付款后自动回复"""
+    order_id, status, user_url = event['order_id'], event['status'], event['user_url']
+
+    await self.run_blocking(self.db_manager.update_order_status, order_id, status)
+    logger.info(f"订单状态已更新: {order_id} -> {status}")
+
+    await self.run_blocking(
+        self.db_manager.save_order_message,
+        order_id=order_id,
+        message=ORDER_STATUS_MESSAGES[status],
+        user_url=user_url
+    )
+    logger.info(f"订单消息已保存: {order_id} -> {ORDER_STATUS_MESSAGES[status]}")
+
+    if status != '等待卖家发货':
+        metrics.observe('order_events.handle_latency', time.time() - event['received_at'])
+        return
+
+    # 从数据库 chat_message 检索 user_id 和 local_id，取最新一条消息
+    chat_msgs = await self.run_blocking(self.db_manager.get_chat_messages, order_id=order_id, limit=1)
+    if not chat_msgs:
+        logger.warning(f"未找到order_id={order_id}的聊天消息，无法自动回复")
+        return
+
+    msg = chat_msgs[0]
+    user_id = msg['user_id'] if isinstance(msg, dict) else msg[1]
+    local_id = msg['local_id'] if isinstance(msg, dict) else msg[3]
+
+    # 生成回复
+    reply = await self.bot.agenerate(
+        user_msg="您的订单已付款，卖家会尽快发货，请耐心等待。",
+        user_id=user_id,
+        order_id=order_id
+    )
+
+    # 保存机器人回复到MySQL
+    await self.run_blocking(
+        self.db_manager.save_chat_message,
+        user_id=user_id,
+        user_name="me",
+        local_id=local_id,
+        chat=reply,
+        url=None,
+        order_id=order_id,
+        chat_type='text'
+    )
+
+    # 发送消息
+    await self.send_msg(
+        self.ws,
+        order_id,
+        user_id,
+        reply
+    )
+    # 从收到 WebSocket 事件到回复进入发送队列的耗时
+    metrics.observe('order_events.reply_latency', time.time() - event['received_at'])
+
+    logger.info(f"已自动回复等待卖家发货订单: {order_id}")
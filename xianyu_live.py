@@ -4,38 +4,68 @@ import asyncio
 import time
 import os
 import websockets
-import redis
-import threading
 import sys
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from loguru import logger
 from dotenv import load_dotenv
 from cookie_fetcher import refresh_and_get_cookies
 from XianyuApis import XianyuApis
 from mysql_manager import XianyuMySQLManager
 from utils.xianyu_utils import generate_mid, generate_uuid, trans_cookies, generate_device_id, decrypt
-from XianyuAgent import DifyAgent
-from worker import start_workers, stop_workers, message_worker, batch_process_messages, process_wait_ship_orders
-from heartbeat import send_heartbeat, heartbeat_loop, handle_heartbeat_response
+from XianyuAgent import DifyAgent, IntentRouter
+from outbound import OutboundQueue
+from reconnect import Backoff, TokenError, refresh_session
+from sync_cursor import SyncCursor
+from redis_client import create_redis, create_async_redis
+from message_queue import create_lane_queue, RedisStreamQueue, LANE_CHAT, DEFAULT_LANE_WEIGHTS
+from debounce import DebounceScheduler
+from order_events import OrderEventStream
+from dead_letter import RetryQueue
+from slots import ConversationSlots
+from dify_conversations import DifyConversations
+from reply_cache import ReplyCache
+import metrics
+from worker import (
+    start_workers, stop_workers, message_worker, cancel_obsolete_reply, complete_message, batch_process_messages, process_due_order,
+    reply_to_order, deliver_reply, reply_cache_key, process_order_events, process_order_event, handle_order_event, run_blocking,
+    retry_mover, metrics_reporter
+)
+from heartbeat import send_heartbeat, heartbeat_loop, handle_heartbeat_response, RttEstimator
 from message_handler import (
-    handle_message, _handle_message, send_msg, init,
+    handle_message, decrypt_sync_package, _handle_sync_message, send_msg, send_ack, init,
     is_chat_message, is_sync_package, is_typing_status
 )
 
 class XianyuLive:
     def __init__(self, cookies_str, bot=None):
-        # 方法绑定（必须在任何线程启动前）
+        # 方法绑定（必须在任何任务启动前）
+        self.run_blocking = run_blocking.__get__(self)
         self.start_workers = start_workers.__get__(self)
         self.stop_workers = stop_workers.__get__(self)
         self.message_worker = message_worker.__get__(self)
+        self.cancel_obsolete_reply = cancel_obsolete_reply.__get__(self)
+        self.complete_message = complete_message.__get__(self)
         self.batch_process_messages = batch_process_messages.__get__(self)
-        self.process_wait_ship_orders = process_wait_ship_orders.__get__(self)
+        self.process_due_order = process_due_order.__get__(self)
+        self.reply_to_order = reply_to_order.__get__(self)
+        self.deliver_reply = deliver_reply.__get__(self)
+        self.reply_cache_key = reply_cache_key.__get__(self)
+        self.retry_mover = retry_mover.__get__(self)
+        self.metrics_reporter = metrics_reporter.__get__(self)
+        self.process_order_events = process_order_events.__get__(self)
+        self.process_order_event = process_order_event.__get__(self)
+        self.handle_order_event = handle_order_event.__get__(self)
         self.send_heartbeat = send_heartbeat.__get__(self)
         self.heartbeat_loop = heartbeat_loop.__get__(self)
         self.handle_heartbeat_response = handle_heartbeat_response.__get__(self)
         self.handle_message = handle_message.__get__(self)
-        self._handle_message = _handle_message.__get__(self)
+        self.send_ack = send_ack.__get__(self)
+        self.decrypt_sync_package = decrypt_sync_package.__get__(self)
+        self._handle_sync_message = _handle_sync_message.__get__(self)
         self.send_msg = send_msg.__get__(self)
         self.init = init.__get__(self)
+        self.refresh_session = refresh_session.__get__(self)
         self.is_chat_message = is_chat_message.__get__(self)
         self.is_sync_package = is_sync_package.__get__(self)
         self.is_typing_status = is_typing_status.__get__(self)
@@ -51,48 +81,142 @@ class XianyuLive:
         # 批量处理消息的时间阈值（秒）
         self.message_batch_threshold = 5
         
-        # Redis配置
-        self.redis_client = redis.Redis(
-            host='localhost',
-            port=6379,
-            db=0,
-            decode_responses=True
-        )
+        # Redis配置（REDIS_HOST 等环境变量），同步客户端用于线程池中的调用，
+        # asyncio 客户端用于事件循环中的逐条消息写入，两者各自共享连接池
+        self.redis_client = create_redis()
+        self.aredis = create_async_redis()
         self.message_queue_key = 'xianyu:messages'
         self.processing_queue_key = 'xianyu:processing'
+        # 消息队列后端：list（默认）或 stream（Redis Streams 消费者组）
+        self.queue_backend = os.getenv('XIANYU_QUEUE_BACKEND', 'list')
+        self.queue_visibility_timeout = int(os.getenv('XIANYU_QUEUE_VISIBILITY_TIMEOUT', '60'))  # 未确认消息被重新认领的超时（秒）
+        # 优先级通道：订单状态 > 聊天 > 其他，都有积压时按权重比例取消息
+        self.queue_lane_weights = dict(DEFAULT_LANE_WEIGHTS)
+        self.message_queue = create_lane_queue(
+            self.redis_client,
+            backend=self.queue_backend,
+            weights=self.queue_lane_weights,
+            queue_key=self.message_queue_key,
+            processing_key=self.processing_queue_key,
+            visibility_timeout=self.queue_visibility_timeout
+        )
+        # 处理失败的消息按指数退避重试，超过最大次数写入死信队列（dlq_admin.py 管理）
+        self.max_message_attempts = 5
+        self.retry_base_delay = 1    # 首次重试等待（秒），之后每次翻倍
+        self.retry_max_delay = 300   # 重试等待上限（秒）
+        self.retry_queue = RetryQueue(
+            self.redis_client,
+            self.message_queue,
+            max_attempts=self.max_message_attempts,
+            base_delay=self.retry_base_delay,
+            max_delay=self.retry_max_delay
+        )
+        self.retry_event = None  # 有新的重试登记时唤醒重试任务
         self.chat_messages_key = 'xianyu:chat_messages'  # 新增：存储聊天消息的Redis键
-        self.order_first_message_time = {}  # 记录每个order_id的首次消息时间
+        # 防抖调度：ZSET 记录 order_id -> 到期时间，批量回复任务只处理到期的会话；
+        # 处理会话时持有租约，多个进程可同时运行批量回复任务
+        self.batch_lease_ttl = 60  # 会话租约时长（秒），需大于一次生成并发送回复的耗时
+        self.debounce = DebounceScheduler(self.redis_client, lease_ttl=self.batch_lease_ttl)
+        self.debounce_event = None  # 有新会话登记时唤醒批量回复任务
+        self.debounce_max_sleep = 1  # 批量回复任务最长休眠（秒）
+        # 订单事件流：订单状态变化发布后由订单处理任务立即处理
+        self.order_events = OrderEventStream(self.redis_client)
+        self.order_event = None  # 有新订单事件时唤醒订单处理任务
+        # Dify 会话映射：(user_id, order_id) -> conversation_id，已有会话时不再拼接历史消息
+        self.dify_conversation_ttl = 7 * 86400
+        self.dify_conversations = DifyConversations(self.redis_client, ttl=self.dify_conversation_ttl)
+        # 回复缓存：同一商品下意图与问题相同的非议价问题复用回复，XIANYU_REPLY_CACHE_TTL=0 关闭
+        self.reply_cache = ReplyCache(
+            capacity=int(os.getenv('XIANYU_REPLY_CACHE_SIZE', '1000')),
+            ttl=int(os.getenv('XIANYU_REPLY_CACHE_TTL', '3600')),
+            aredis=self.aredis if os.getenv('XIANYU_REPLY_CACHE_REDIS') == '1' else None,
+            cacheable=lambda reply: bool(reply) and reply not in (
+                DifyAgent.FALLBACK_REPLY, DifyAgent.ERROR_REPLY, DifyAgent.BUSY_REPLY)
+        )
+        self.intent_router = IntentRouter(None)  # 只使用关键词规则判断意图，不调用大模型
+        # 同步游标：重连后从上次入队的位置继续同步
+        self.sync_cursor = SyncCursor(self.redis_client, self.myid)
+        self.sync_resume_max_age = 3600  # 断线补发消息的最大时效（秒）
         
-        # 线程相关配置
-        self.max_workers = 10  # 最大工作线程数
-        self.worker_threads = []
-        self.stop_event = threading.Event()
+        # 任务相关配置：所有处理都作为任务运行在 main() 的事件循环中
+        # 会话处理槽：按 order_id 哈希分区，同一会话严格按顺序处理，不同会话并行
+        self.conversation_slots = int(os.getenv('XIANYU_CONVERSATION_SLOTS', '10'))
+        self.slots = ConversationSlots(self.conversation_slots)
+        self.message_fetch_batch = 10  # 分发任务每次从队列取出的消息数
+        self.pending_messages = set()  # 已提交到处理槽、等待确认的消息
+        self.batch_inflight = set()    # 已启动、尚未完成的批量回复 order_id
+        self.reply_tasks = set()       # 正在进行的批量回复任务
+        self.generations = {}          # order_id -> 正在生成的回复，买家发来新消息时取消
+        self.metrics_interval = int(os.getenv('XIANYU_METRICS_INTERVAL', '60'))  # 输出运行状态的间隔（秒）
+        self.worker_tasks = []
+        self.stop_event = None   # 在事件循环中创建
+        self.queue_event = None  # 有新消息入队时唤醒处理任务
+        # 阻塞操作（Redis/MySQL/HTTP/大模型调用）使用的有界线程池
+        self.max_blocking_workers = 16
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.max_blocking_workers,
+            thread_name_prefix='Blocking'
+        )
         
         # 心跳相关配置
         self.heartbeat_interval = 15  # 心跳间隔15秒
-        self.heartbeat_timeout = 5    # 心跳超时5秒
+        self.heartbeat_timeout = 5    # 心跳超时上限5秒（尚无RTT样本时使用）
+        self.heartbeat_min_interval = 5   # RTT 变差时缩短到的心跳间隔
+        self.heartbeat_min_timeout = 1    # 心跳超时下限
+        self.heartbeat_rtt_multiplier = 4  # 超时约为 k×RTT
+        self.pending_heartbeats = {}  # 已发送未响应的心跳 mid -> 发送时间（尚未发出时为 None）
+        self.heartbeat_rtt = RttEstimator()
+        self.heartbeat_event = None
         self.last_heartbeat_time = 0
         self.last_heartbeat_response = 0
         self.heartbeat_task = None
         self.ws = None
-        
-        #启动定时处理线程
-        self.batch_process_thread = threading.Thread(
-            target=self.batch_process_messages,
-            daemon=True
-        )
-        self.batch_process_thread.start()
+        # 当前连接已确认过的mid，保证每个mid只ACK一次
+        self.acked_mids = OrderedDict()
+        self.acked_mids_limit = 4096
 
-        # 新增：每10秒轮询 Redis，处理订单
-        self.order_wait_ship_thread = threading.Thread(
-            target=self.process_wait_ship_orders,
-            daemon=True
+        # 出站队列配置：所有 ws 发送由单一写任务完成
+        self.outbound_max_depth = 1000  # 聊天回复最大排队数，超过后背压
+        self.send_rate_limit = 2.0      # 每秒最多发送的聊天回复数
+        self.send_burst = 5             # 限速突发容量
+        self.outbound = OutboundQueue(
+            max_depth=self.outbound_max_depth,
+            rate=self.send_rate_limit,
+            burst=self.send_burst
         )
-        self.order_wait_ship_thread.start()
+
+        # 断线重连配置：带抖动的指数退避，进程内重新注册
+        self.reconnect_base_delay = 1     # 首次重连等待（秒）
+        self.reconnect_max_delay = 60     # 最大重连等待（秒）
+        self.token_failures_before_refresh = 3  # accessToken 连续失败多少次后刷新Cookie
+        self.cookie_refresher = refresh_and_get_cookies
+
+    async def _stop_heartbeat(self):
+        if self.heartbeat_task:
+            self.heartbeat_task.cancel()
+            try:
+                await self.heartbeat_task
+            except asyncio.CancelledError:
+                pass
+            self.heartbeat_task = None
 
     async def main(self):
-        # 启动工作线程
+        # 启动消息处理、批量回复和订单处理任务
         self.start_workers()
+        chat_queue = self.message_queue.lanes[LANE_CHAT]
+        if isinstance(chat_queue, RedisStreamQueue):
+            # 迁移旧列表队列中遗留的消息（包括处理中未确认的）
+            try:
+                await self.run_blocking(chat_queue.migrate_from_list, self.processing_queue_key, self.message_queue_key)
+            except Exception as e:
+                logger.error(f"迁移列表队列失败: {e}")
+        try:
+            await self.run_blocking(self.sync_cursor.load)
+        except Exception as e:
+            logger.error(f"加载同步游标失败，将从当前时间开始同步: {e}")
+        backoff = Backoff(self.reconnect_base_delay, self.reconnect_max_delay)
+        token_failures = 0
+        disconnected_at = None  # 首次断开的时间，注册成功后计算重连耗时
         
         try:
             while True:
@@ -111,7 +235,17 @@ class XianyuLive:
 
                     async with websockets.connect(self.base_url, extra_headers=headers) as websocket:
                         self.ws = websocket
+                        self.acked_mids.clear()
                         await self.init(websocket)
+                        # 注册完成后才开始发送积压的出站消息
+                        self.outbound.attach(websocket)
+                        backoff.reset()
+                        token_failures = 0
+                        metrics.set_gauge('reconnect.consecutive_failures', 0)
+                        if disconnected_at is not None:
+                            metrics.observe('reconnect.reregister_time', time.monotonic() - disconnected_at)
+                            logger.info(f"重连成功，耗时 {time.monotonic() - disconnected_at:.2f} 秒")
+                            disconnected_at = None
                         
                         # 初始化心跳时间
                         self.last_heartbeat_time = time.time()
@@ -123,26 +257,14 @@ class XianyuLive:
                         async for message in websocket:
                             try:
                                 message_data = json.loads(message)
-                                
+
+                                # 先发送ACK（每个mid只确认一次），再做其他处理
+                                await self.send_ack(message_data)
+
                                 # 处理心跳响应
                                 if await self.handle_heartbeat_response(message_data):
                                     continue
-                                
-                                # 发送通用ACK响应
-                                if "headers" in message_data and "mid" in message_data["headers"]:
-                                    ack = {
-                                        "code": 200,
-                                        "headers": {
-                                            "mid": message_data["headers"]["mid"],
-                                            "sid": message_data["headers"].get("sid", "")
-                                        }
-                                    }
-                                    # 复制其他可能的header字段
-                                    for key in ["app-key", "ua", "dt"]:
-                                        if key in message_data["headers"]:
-                                            ack["headers"][key] = message_data["headers"][key]
-                                    await websocket.send(json.dumps(ack))
-                                
+
                                 # 将消息放入Redis队列
                                 await self.handle_message(message_data, websocket)
 
@@ -152,29 +274,41 @@ class XianyuLive:
                                 logger.error(f"处理消息时发生错误: {str(e)}")
                                 #logger.debug(f"原始消息: {message}")
 
+                        logger.warning("WebSocket连接已关闭")
+
                 except websockets.exceptions.ConnectionClosed:
                     logger.warning("WebSocket连接已关闭")
-                    if self.heartbeat_task:
-                        self.heartbeat_task.cancel()
-                        try:
-                            await self.heartbeat_task
-                        except asyncio.CancelledError:
-                            pass
-                    await asyncio.sleep(5)  # 等待5秒后重连
-                    
+
+                except TokenError as e:
+                    token_failures += 1
+                    metrics.inc('reconnect.token_failures')
+                    logger.error(f"{e}（连续 {token_failures} 次）")
+                    # 连续多次获取 token 失败才刷新 Cookie，单次失败可能只是网络抖动
+                    if token_failures >= self.token_failures_before_refresh:
+                        if await self.refresh_session():
+                            token_failures = 0
+
                 except Exception as e:
                     logger.error(f"连接发生错误: {e}")
-                    if self.heartbeat_task:
-                        self.heartbeat_task.cancel()
-                        try:
-                            await self.heartbeat_task
-                        except asyncio.CancelledError:
-                            pass
-                    # 直接重启程序
-                    os.execv(sys.executable, [sys.executable] + sys.argv)
+
+                # 断线后在进程内重连，后台任务、线程池和出站队列保持不变
+                self.outbound.detach()
+                await self._stop_heartbeat()
+                self.ws = None
+                if disconnected_at is None:
+                    disconnected_at = time.monotonic()
+                delay = backoff.next()
+                metrics.inc('reconnect.count')
+                metrics.set_gauge('reconnect.consecutive_failures', backoff.attempts)
+                logger.info(f"{delay:.1f} 秒后进行第 {backoff.attempts} 次重连")
+                await asyncio.sleep(delay)
         finally:
-            # 确保在程序退出时停止工作线程
-            self.stop_workers()
+            # 确保在程序退出时停止后台任务
+            await self._stop_heartbeat()
+            await self.stop_workers()
+            await self.aredis.aclose()
+            if hasattr(self.bot, 'aclose'):
+                await self.bot.aclose()
 
 # ... 这里复制 XianyuLive 类的全部内容 ...
 # class XianyuLive: